@@ -3,3 +3,5 @@ from ._geom import MultiPoint, Point
 from ._geom import Polygon, Polyline
 from ._geom import Envelope, SpatialReference
 from . import _utils
+from ._cache import BlockCache
+from ._cache import SQLiteCache
@@ -201,6 +201,8 @@ class BaseService(OrderedDict):
     #----------------------------------------------------------------------
     def __iter__(self):
         """creates iterable for classes properties"""
+        if self._json_dict is None:
+            self.init()
         for k,v in self._json_dict.items():
             yield k,v
     #----------------------------------------------------------------------
@@ -0,0 +1,360 @@
+"""
+Client side caches used to avoid asking a server for the same data twice.
+"""
+from __future__ import absolute_import
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+try:
+    import numpy as np
+    hasNumPy = True
+except ImportError:
+    hasNumPy = False
+#----------------------------------------------------------------------
+def make_key(*parts):
+    """builds a stable hash key from JSON serializable parts"""
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+#----------------------------------------------------------------------
+def _replace(src, dst):
+    """moves src over dst, replacing it when it exists"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # python 2: rename replaces an existing file on posix only, on
+        # windows the block written by the other process is kept
+        os.rename(src, dst)
+########################################################################
+class LRUCache(object):
+    """
+    A thread safe, in-memory least recently used cache bounded by the
+    total size in bytes of the values it holds and, optionally, by the
+    number of values.
+
+    Inputs:
+       max_bytes - the byte budget of the cache
+       max_items - optional largest number of values kept
+    """
+    _max_bytes = None
+    _max_items = None
+    _items = None
+    _size = None
+    _lock = None
+    hits = None
+    misses = None
+    #----------------------------------------------------------------------
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_items=None):
+        """Constructor"""
+        self._max_bytes = max_bytes
+        self._max_items = max_items
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    #----------------------------------------------------------------------
+    def get(self, key, default=None):
+        """returns a value and marks it as recently used"""
+        with self._lock:
+            if key in self._items:
+                value, nbytes = self._items.pop(key)
+                self._items[key] = (value, nbytes)
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+    #----------------------------------------------------------------------
+    def set(self, key, value, nbytes=0):
+        """adds a value, evicting the least recently used values when the
+        byte budget or the number of values is exceeded"""
+        if nbytes > self._max_bytes or self._max_items == 0:
+            return
+        with self._lock:
+            if key in self._items:
+                self._size -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self._size += nbytes
+            while self._size > self._max_bytes or \
+                  (self._max_items and len(self._items) > self._max_items):
+                _, (_, old_bytes) = self._items.popitem(last=False)
+                self._size -= old_bytes
+    #----------------------------------------------------------------------
+    def clear(self):
+        """removes every value"""
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+    #----------------------------------------------------------------------
+    @property
+    def size(self):
+        """returns the number of bytes held"""
+        return self._size
+    #----------------------------------------------------------------------
+    def __len__(self):
+        return len(self._items)
+    #----------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self._items
+########################################################################
+class BlockCache(object):
+    """
+    Caches decoded pixel blocks (numpy arrays) read from image services.
+    Blocks are kept in an in-memory LRU bounded by max_bytes and, when a
+    folder is given, are also saved as .npy files so they survive the
+    process and can be shared with other processes.
+
+    Inputs:
+       max_bytes - in-memory byte budget, default 256MB
+       folder - optional folder for the on-disk store
+    """
+    _memory = None
+    _folder = None
+    disk_hits = None
+    #----------------------------------------------------------------------
+    def __init__(self, max_bytes=256 * 1024 * 1024, folder=None):
+        """Constructor"""
+        if not hasNumPy:
+            raise ImportError("numpy is required for the block cache")
+        self._memory = LRUCache(max_bytes=max_bytes)
+        self._folder = folder
+        self.disk_hits = 0
+        if folder is not None and \
+           os.path.isdir(folder) == False:
+            os.makedirs(folder)
+    #----------------------------------------------------------------------
+    @staticmethod
+    def block_key(url, resolution, row, col, block_size,
+                  bandIds=None, renderingRule=None, mosaicRule=None,
+                  **kwargs):
+        """
+        builds the key of a block from the service url, its position in
+        the block grid, the bands and the rendering and mosaic rules.
+        Any other request parameter that changes the pixels is passed as
+        a keyword.
+        """
+        return make_key(url, ["%.12g" % r for r in resolution],
+                        row, col, block_size, bandIds,
+                        renderingRule, mosaicRule, kwargs)
+    #----------------------------------------------------------------------
+    def _path(self, key):
+        return os.path.join(self._folder, "%s.npy" % key)
+    #----------------------------------------------------------------------
+    def get(self, key):
+        """returns the cached block or None"""
+        arr = self._memory.get(key)
+        if arr is not None or self._folder is None:
+            return arr
+        path = self._path(key)
+        if os.path.isfile(path):
+            try:
+                arr = np.load(path)
+            except (IOError, ValueError):
+                return None
+            self.disk_hits += 1
+            self._memory.set(key, arr, arr.nbytes)
+        return arr
+    #----------------------------------------------------------------------
+    def set(self, key, arr):
+        """
+        stores a block. The .npy file is written to a temporary file of
+        the folder and moved into place, so readers in other threads or
+        processes never see a partial block. A block that cannot be
+        written is only kept in memory.
+        """
+        self._memory.set(key, arr, arr.nbytes)
+        if self._folder is not None:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self._folder)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, arr)
+                _replace(tmp, self._path(key))
+            except (IOError, OSError):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+    #----------------------------------------------------------------------
+    def clear(self, disk=False):
+        """empties the memory cache and, optionally, the on-disk store"""
+        self._memory.clear()
+        if disk and self._folder is not None:
+            for name in os.listdir(self._folder):
+                if name.endswith(".npy"):
+                    os.remove(os.path.join(self._folder, name))
+    #----------------------------------------------------------------------
+    @property
+    def stats(self):
+        """returns the hit and miss counts of the cache"""
+        return {"memoryHits" : self._memory.hits,
+                "diskHits" : self.disk_hits,
+                "misses" : self._memory.misses - self.disk_hits,
+                "memoryBytes" : self._memory.size,
+                "blocks" : len(self._memory)}
+########################################################################
+class SQLiteCache(object):
+    """
+    A persistent key/value cache of JSON values stored in a SQLite file.
+    Values expire after ttl seconds. The database runs in WAL mode so
+    several processes can read and write the same file at once.
+
+    Inputs:
+       path - the SQLite file, created when it does not exist
+       ttl - the number of seconds a value is kept, default one day
+       namespace - name used to keep unrelated values apart in one file
+    """
+    _path = None
+    _local = None
+    _lock = None
+    _pending = None
+    ttl = None
+    namespace = None
+    hits = None
+    misses = None
+    #----------------------------------------------------------------------
+    def __init__(self, path, ttl=86400, namespace="default"):
+        """Constructor"""
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = [0, 0]
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._connection()
+    #----------------------------------------------------------------------
+    def _connection(self):
+        """returns the connection of the calling thread"""
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self._path, timeout=30,
+                                  isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "namespace TEXT, key TEXT, value TEXT, "
+                        "expires REAL, PRIMARY KEY (namespace, key))")
+            con.execute("CREATE TABLE IF NOT EXISTS stats ("
+                        "namespace TEXT PRIMARY KEY, hits INTEGER, "
+                        "misses INTEGER)")
+            self._local.con = con
+        return con
+    #----------------------------------------------------------------------
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self._pending[0] += 1
+            else:
+                self.misses += 1
+                self._pending[1] += 1
+            flush = sum(self._pending) >= 1000
+        if flush:
+            self.flush_stats()
+    #----------------------------------------------------------------------
+    def get(self, key):
+        """returns the value of a key or None when missing or expired"""
+        row = self._connection().execute(
+            "SELECT value, expires FROM entries "
+            "WHERE namespace = ? AND key = ?",
+            (self.namespace, key)).fetchone()
+        if row is None or row[1] < time.time():
+            self._count(False)
+            return None
+        self._count(True)
+        return json.loads(row[0])
+    #----------------------------------------------------------------------
+    def set(self, key, value, ttl=None):
+        """stores a JSON serializable value"""
+        if ttl is None:
+            ttl = self.ttl
+        self._connection().execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), time.time() + ttl))
+    #----------------------------------------------------------------------
+    def set_many(self, items, ttl=None):
+        """stores a list of (key, value) pairs in one transaction"""
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl
+        con = self._connection()
+        con.execute("BEGIN")
+        try:
+            con.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [(self.namespace, k, json.dumps(v), expires)
+                 for k, v in items])
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    #----------------------------------------------------------------------
+    def delete(self, key):
+        """removes a key"""
+        self._connection().execute(
+            "DELETE FROM entries WHERE namespace = ? AND key = ?",
+            (self.namespace, key))
+    #----------------------------------------------------------------------
+    def purge(self):
+        """removes the expired values and returns how many were removed"""
+        cur = self._connection().execute(
+            "DELETE FROM entries WHERE namespace = ? AND expires < ?",
+            (self.namespace, time.time()))
+        return cur.rowcount
+    #----------------------------------------------------------------------
+    def clear(self):
+        """removes every value of the namespace"""
+        self._connection().execute(
+            "DELETE FROM entries WHERE namespace = ?", (self.namespace,))
+    #----------------------------------------------------------------------
+    def flush_stats(self):
+        """adds the hits and misses of this process to the shared totals"""
+        with self._lock:
+            hits, misses = self._pending
+            self._pending = [0, 0]
+        if hits == 0 and misses == 0:
+            return
+        con = self._connection()
+        con.execute("INSERT OR IGNORE INTO stats VALUES (?, 0, 0)",
+                    (self.namespace,))
+        con.execute("UPDATE stats SET hits = hits + ?, misses = misses + ? "
+                    "WHERE namespace = ?", (hits, misses, self.namespace))
+    #----------------------------------------------------------------------
+    @property
+    def hit_rate(self):
+        """returns the share of lookups answered by this process's cache"""
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / float(total)
+    #----------------------------------------------------------------------
+    @property
+    def stats(self):
+        """
+        returns the hits, misses and hit rate of this process and the
+        totals of every process sharing the file
+        """
+        self.flush_stats()
+        row = self._connection().execute(
+            "SELECT hits, misses FROM stats WHERE namespace = ?",
+            (self.namespace,)).fetchone() or (0, 0)
+        total = row[0] + row[1]
+        return {"hits" : self.hits,
+                "misses" : self.misses,
+                "hitRate" : self.hit_rate,
+                "totalHits" : row[0],
+                "totalMisses" : row[1],
+                "totalHitRate" : row[0] / float(total) if total else 0.0}
+    #----------------------------------------------------------------------
+    def close(self):
+        """saves the statistics and closes the calling thread's connection"""
+        self.flush_stats()
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            con.close()
+            self._local.con = None
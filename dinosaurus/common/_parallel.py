@@ -0,0 +1,149 @@
+"""
+Helpers to run many REST calls at once against a single connection.
+
+The calls made by this package are I/O bound, so a small thread pool is
+enough to keep several requests in flight without overwhelming a server.
+"""
+from __future__ import absolute_import
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError
+
+DEFAULT_WORKERS = 8
+#----------------------------------------------------------------------
+def imap(func, iterable, max_workers=DEFAULT_WORKERS,
+         ordered=True, return_exceptions=False):
+    """
+    Applies a function to every item of an iterable using a bounded
+    thread pool.
+
+    The iterable is consumed lazily, so at most two times max_workers
+    items are held in memory at any time, counting both the calls in
+    flight and the results waiting for a slower earlier item in ordered
+    mode.
+
+    Inputs:
+       func - callable taking a single item
+       iterable - items to process
+       max_workers - the number of calls to keep in flight
+       ordered - if True, results are yielded in input order, else they
+        are yielded as soon as they complete
+       return_exceptions - if True, a failed call yields the exception
+        instead of raising it
+    Output:
+       generator of (index, result) tuples
+    """
+    if max_workers is None or max_workers < 1:
+        max_workers = 1
+    items = enumerate(iterable)
+    pending = {}
+    done_results = {}
+    next_index = 0
+    limit = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for index, item in itertools.islice(items, limit):
+            pending[pool.submit(func, item)] = index
+        while pending:
+            finished, _ = wait(list(pending.keys()),
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not return_exceptions:
+                        for f in pending:
+                            f.cancel()
+                        raise
+                    result = e
+                done_results[index] = result
+            if ordered:
+                while next_index in done_results:
+                    yield next_index, done_results.pop(next_index)
+                    next_index += 1
+            else:
+                for index in sorted(done_results.keys()):
+                    yield index, done_results.pop(index)
+            # results held back for a slow earlier item use up the
+            # submission budget, so they cannot pile up
+            free = limit - len(pending) - len(done_results)
+            for nindex, nitem in itertools.islice(items, max(0, free)):
+                pending[pool.submit(func, nitem)] = nindex
+#----------------------------------------------------------------------
+def run_all(calls, max_workers=DEFAULT_WORKERS, timeout=None):
+    """
+    Runs a dictionary of zero argument callables concurrently.
+
+    Each call runs on its own thread, with at most max_workers calls
+    running at once. A call that takes longer than timeout seconds,
+    counted from the moment it starts, is reported as timed out and no
+    longer holds a slot, so the calls queued behind it still get their
+    full timeout. A timed out call is left to finish in the background
+    and its result is discarded.
+
+    Inputs:
+       calls - dictionary of name to callable
+       max_workers - the number of calls to keep in flight
+       timeout - optional number of seconds each call may take
+    Output:
+       dictionary of name to a dictionary with the keys: result, error
+       and elapsed (seconds the call ran)
+    """
+    report = {}
+    if not calls:
+        return report
+    max_workers = max(1, max_workers or 1)
+    queue = list(calls.items())
+    running = {}
+    condition = threading.Condition()
+    def _run(call, box):
+        start = time.time()
+        try:
+            box['result'] = call()
+        except Exception as e:
+            box['error'] = e
+        with condition:
+            box['elapsed'] = time.time() - start
+            box['done'] = True
+            condition.notify()
+    with condition:
+        while queue or running:
+            while queue and len(running) < max_workers:
+                name, call = queue.pop(0)
+                box = {}
+                thread = threading.Thread(target=_run, args=(call, box))
+                thread.daemon = True
+                running[name] = (time.time(), box)
+                thread.start()
+            now = time.time()
+            changed = False
+            for name, (start, box) in list(running.items()):
+                if box.get('done', False):
+                    report[name] = {"result" : box.get('result', None),
+                                    "error" : box.get('error', None),
+                                    "elapsed" : box['elapsed']}
+                elif timeout is not None and now - start >= timeout:
+                    report[name] = {"result" : None,
+                                    "error" : TimeoutError(
+                                        "timed out after %ss" % timeout),
+                                    "elapsed" : now - start}
+                else:
+                    continue
+                del running[name]
+                changed = True
+            if running and not changed:
+                wait_for = None
+                if timeout is not None:
+                    wait_for = max(0.0, min(start for start, _ in
+                                            running.values()) +
+                                   timeout - now)
+                condition.wait(wait_for)
+    return report
+#----------------------------------------------------------------------
+def timed(func, *args, **kwargs):
+    """calls a function and returns a tuple of (result, elapsed seconds)"""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
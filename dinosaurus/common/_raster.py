@@ -0,0 +1,331 @@
+"""
+Helpers used to request large images from a service in server sized
+pieces and to assemble them into a single georeferenced raster on disk.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import os
+import math
+import struct
+import tempfile
+import six
+try:
+    import numpy as np
+    hasNumPy = True
+except ImportError:
+    hasNumPy = False
+try:
+    from PIL import Image
+    hasPIL = True
+except ImportError:
+    hasPIL = False
+try:
+    import tifffile
+    hasTiffFile = True
+except ImportError:
+    hasTiffFile = False
+try:
+    import lerc
+    hasLerc = True
+except ImportError:
+    hasLerc = False
+from ._utils import create_uid
+
+_SAMPLE_FORMATS = {"u" : 1, "i" : 2, "f" : 3}
+_PIXEL_TYPES = {
+    "U1" : "uint8", "U2" : "uint8", "U4" : "uint8",
+    "U8" : "uint8", "S8" : "int8",
+    "U16" : "uint16", "S16" : "int16",
+    "U32" : "uint32", "S32" : "int32",
+    "F32" : "float32", "F64" : "float64",
+    "C64" : "complex64", "C128" : "complex128"
+}
+#----------------------------------------------------------------------
+def _require_numpy():
+    if not hasNumPy:
+        raise ImportError("numpy is required for this operation")
+#----------------------------------------------------------------------
+def pixel_dtype(pixelType):
+    """returns the numpy data type name of an image service pixelType"""
+    if pixelType is None:
+        return None
+    return _PIXEL_TYPES.get(pixelType.upper(), None)
+#----------------------------------------------------------------------
+def parse_bbox(bbox):
+    """
+    converts a bounding box given as a comma delimited string, a list or
+    an envelope dictionary into a list of [xmin, ymin, xmax, ymax]
+    """
+    if isinstance(bbox, dict) or hasattr(bbox, 'xmin'):
+        keys = ('xmin', 'ymin', 'xmax', 'ymax')
+        if isinstance(bbox, dict):
+            return [float(bbox[k]) for k in keys]
+        return [float(getattr(bbox, k)) for k in keys]
+    if isinstance(bbox, six.string_types):
+        bbox = bbox.split(',')
+    return [float(v) for v in bbox]
+#----------------------------------------------------------------------
+def parse_size(size):
+    """converts a size given as "w,h", "w h" or [w, h] into [w, h]"""
+    if isinstance(size, six.string_types):
+        size = size.replace(" ", ",").split(',')
+        size = [v for v in size if v != ""]
+    return [int(size[0]), int(size[1])]
+#----------------------------------------------------------------------
+def square_pixels(bbox, size):
+    """
+    expands the bounding box so the pixels are square, the same way the
+    server does when the aspect ratio of bbox and size do not agree
+    """
+    xmin, ymin, xmax, ymax = bbox
+    width, height = size
+    res = max((xmax - xmin) / width, (ymax - ymin) / height)
+    cx = (xmin + xmax) / 2.0
+    cy = (ymin + ymax) / 2.0
+    return [cx - res * width / 2.0, cy - res * height / 2.0,
+            cx + res * width / 2.0, cy + res * height / 2.0]
+#----------------------------------------------------------------------
+def split_extent(bbox, size, max_width, max_height):
+    """
+    Splits an extent and its pixel size into tiles that are no larger
+    than max_width by max_height pixels. The tiles share pixel edges so
+    they can be placed next to each other without resampling.
+
+    Inputs:
+       bbox - [xmin, ymin, xmax, ymax] of the whole image
+       size - [width, height] of the whole image in pixels
+       max_width - the largest tile width the server allows
+       max_height - the largest tile height the server allows
+    Output:
+       list of dictionaries with the keys: row, col, x, y (pixel offset
+       of the tile from the upper left corner), width, height and bbox
+    """
+    xmin, ymin, xmax, ymax = bbox
+    width, height = size
+    resx = (xmax - xmin) / width
+    resy = (ymax - ymin) / height
+    tiles = []
+    rows = int(math.ceil(height / float(max_height)))
+    cols = int(math.ceil(width / float(max_width)))
+    for row in range(rows):
+        y = row * max_height
+        h = min(max_height, height - y)
+        for col in range(cols):
+            x = col * max_width
+            w = min(max_width, width - x)
+            tiles.append({
+                "row" : row,
+                "col" : col,
+                "x" : x,
+                "y" : y,
+                "width" : w,
+                "height" : h,
+                "bbox" : [xmin + x * resx,
+                          ymax - (y + h) * resy,
+                          xmin + (x + w) * resx,
+                          ymax - y * resy]
+            })
+    return tiles
+#----------------------------------------------------------------------
+def world_file_path(path):
+    """returns the world file name for an image, ex: map.tif -> map.tfw"""
+    base, ext = os.path.splitext(path)
+    ext = ext.lstrip('.')
+    if len(ext) >= 2:
+        return "%s.%s%sw" % (base, ext[0], ext[-1])
+    return "%s.%sw" % (base, ext)
+#----------------------------------------------------------------------
+def write_world_file(path, bbox, size):
+    """
+    writes the world file for an image covering bbox at the given pixel
+    size and returns the world file path
+    """
+    xmin, ymin, xmax, ymax = bbox
+    width, height = size
+    resx = (xmax - xmin) / width
+    resy = (ymax - ymin) / height
+    wld = world_file_path(path)
+    with open(wld, 'w') as f:
+        f.write("\n".join(["%.12f" % v for v in [resx, 0.0, 0.0, -resy,
+                                                 xmin + resx / 2.0,
+                                                 ymax - resy / 2.0]]))
+        f.write("\n")
+    return wld
+#----------------------------------------------------------------------
+def _ifd_entries(width, height, bands, dtype, data_offset, data_size,
+                 bigtiff):
+    """returns the sorted tag entries of a single strip TIFF"""
+    long_type = 16 if bigtiff else 4
+    if bands >= 3:
+        photometric = 2
+    else:
+        photometric = 1
+    entries = [
+        (256, 4, [width]),
+        (257, 4, [height]),
+        (258, 3, [dtype.itemsize * 8] * bands),
+        (259, 3, [1]),
+        (262, 3, [photometric]),
+        (273, long_type, [data_offset]),
+        (277, 3, [bands]),
+        (278, 4, [height]),
+        (279, long_type, [data_size]),
+        (284, 3, [1]),
+    ]
+    if bands in (2, 4):
+        entries.append((338, 3, [2]))
+    entries.append((339, 3, [_SAMPLE_FORMATS[dtype.kind]] * bands))
+    return entries
+#----------------------------------------------------------------------
+def _tiff_header(width, height, bands, dtype, bigtiff):
+    """builds the header of an uncompressed TIFF and returns it with the
+    offset where the pixel data starts"""
+    sizes = {3 : 2, 4 : 4, 16 : 8}
+    codes = {3 : "H", 4 : "I", 16 : "Q"}
+    data_size = width * height * bands * dtype.itemsize
+    if bigtiff:
+        head = struct.pack("<2sHHHQ", b"II", 43, 8, 0, 16)
+        count_fmt, entry_fmt, next_fmt, inline = "<Q", "<HHQ", "<Q", 8
+    else:
+        head = struct.pack("<2sHI", b"II", 42, 8)
+        count_fmt, entry_fmt, next_fmt, inline = "<H", "<HHI", "<I", 4
+    entries = _ifd_entries(width, height, bands, dtype, 0, data_size, bigtiff)
+    ifd_size = (struct.calcsize(count_fmt) +
+                len(entries) * (struct.calcsize(entry_fmt) + inline) +
+                struct.calcsize(next_fmt))
+    extra_size = sum(sizes[t] * len(v) for _, t, v in entries
+                     if sizes[t] * len(v) > inline)
+    data_offset = len(head) + ifd_size + extra_size
+    data_offset += (16 - data_offset % 16) % 16
+    entries = _ifd_entries(width, height, bands, dtype,
+                           data_offset, data_size, bigtiff)
+    extra_offset = len(head) + ifd_size
+    ifd = struct.pack(count_fmt, len(entries))
+    extra = b""
+    for tag, typ, values in entries:
+        raw = struct.pack("<%d%s" % (len(values), codes[typ]), *values)
+        if len(raw) > inline:
+            ifd += struct.pack(entry_fmt, tag, typ, len(values))
+            ifd += struct.pack("<Q" if bigtiff else "<I",
+                               extra_offset + len(extra))
+            extra += raw
+        else:
+            ifd += struct.pack(entry_fmt, tag, typ, len(values))
+            ifd += raw + b"\x00" * (inline - len(raw))
+    ifd += struct.pack(next_fmt, 0)
+    header = head + ifd + extra
+    header += b"\x00" * (data_offset - len(header))
+    return header, data_offset
+#----------------------------------------------------------------------
+def create_tiff(path, width, height, bands, dtype="uint8"):
+    """
+    Creates an uncompressed TIFF on disk and returns a memory mapped
+    array of shape (height, width, bands) over its pixels. Files larger
+    than 4GB are written as BigTIFF.
+
+    Inputs:
+       path - output .tif file
+       width - width of the image in pixels
+       height - height of the image in pixels
+       bands - number of bands (3 is RGB, 4 is RGBA)
+       dtype - numpy data type of a pixel value
+    """
+    _require_numpy()
+    dtype = np.dtype(dtype).newbyteorder("<")
+    data_size = width * height * bands * dtype.itemsize
+    bigtiff = data_size > 0xFFFFFFFF - 4096
+    header, offset = _tiff_header(width, height, bands, dtype, bigtiff)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.seek(offset + data_size - 1)
+        f.write(b"\x00")
+    return np.memmap(path, dtype=dtype, mode='r+', offset=offset,
+                     shape=(height, width, bands))
+#----------------------------------------------------------------------
+def fetch_image(con, url, params, folder=None):
+    """
+    downloads an image response to a scratch file and returns the path
+    """
+    if folder is None:
+        folder = tempfile.gettempdir()
+    return con.get(path=url,
+                   params=params,
+                   out_folder=folder,
+                   file_name="%s.img" % create_uid())
+#----------------------------------------------------------------------
+def decode_image(path, bands=None):
+    """
+    decodes an image file into an array of shape (height, width, bands)
+    and removes the file
+
+    Inputs:
+       path - image file
+       bands - 3 to return RGB, 4 to return RGBA or None to keep the
+        image's own bands
+    """
+    _require_numpy()
+    if not hasPIL:
+        raise ImportError("Pillow is required to decode images")
+    try:
+        img = Image.open(path)
+        if bands == 3 and img.mode != "RGB":
+            img = img.convert("RGB")
+        elif bands == 4 and img.mode != "RGBA":
+            img = img.convert("RGBA")
+        arr = np.asarray(img)
+        img.close()
+    finally:
+        if os.path.isfile(path):
+            os.remove(path)
+    if arr.ndim == 2:
+        arr = arr[:, :, np.newaxis]
+    return arr
+#----------------------------------------------------------------------
+def decode_raster(path, raster_format="tiff"):
+    """
+    decodes a tiff or lerc pixel block into an array of shape
+    (height, width, bands) and removes the file
+
+    tiff blocks are read with tifffile when it is installed, else with
+    Pillow. lerc blocks require the lerc package.
+    """
+    _require_numpy()
+    try:
+        if raster_format.lower() == "lerc":
+            if not hasLerc:
+                raise ImportError("The lerc package is required to decode lerc blocks")
+            with open(path, 'rb') as f:
+                blob = f.read()
+            result = lerc.decode(blob)
+            if result[0] != 0:
+                raise ValueError("Could not decode the lerc block: %s" % result[0])
+            arr = result[1]
+            info = lerc.getLercBlobInfo(blob)
+            if arr.ndim == 3 and info[6] > 1:
+                # multi-band blobs are returned as (bands, height, width)
+                arr = np.moveaxis(arr, 0, -1)
+        elif hasTiffFile:
+            arr = tifffile.imread(path)
+        elif hasPIL:
+            img = Image.open(path)
+            arr = np.asarray(img)
+            img.close()
+        else:
+            raise ImportError("tifffile or Pillow is required to decode tiff blocks")
+    finally:
+        if os.path.isfile(path):
+            os.remove(path)
+    if arr.ndim == 2:
+        arr = arr[:, :, np.newaxis]
+    return arr
+#----------------------------------------------------------------------
+def create_array(shape, dtype, out_path=None):
+    """
+    returns an empty array, or a memory mapped .npy file when out_path
+    is given
+    """
+    _require_numpy()
+    if out_path is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(out_path, mode='w+',
+                                     dtype=dtype, shape=shape)
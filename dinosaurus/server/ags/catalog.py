@@ -8,6 +8,7 @@ from six.moves.urllib_parse import urlparse
 import json
 from ...common._base import BaseServer
 from ...service._layerfactory import Layer
+from ...common._parallel import imap
 __all__ = ['Catalog']
 ########################################################################
 class Catalog(BaseServer):
@@ -73,12 +74,15 @@ class Catalog(BaseServer):
             else:
                 missing[k] = v
                 setattr(self, k,v)
-        json_dict = connection.get(path=self.root,
-                                 params=params)
-        for k,v in json_dict.items():
-            if k == 'folders':
-                v.insert(0, 'root')
-                setattr(self, "_"+ k, v)
+        # the folder list only comes from the root listing, which is not
+        # requested again once known
+        if url != self.root and self._folders is None:
+            json_dict = connection.get(path=self.root,
+                                       params=params)
+        if url == self.root or self._folders is None:
+            folders = list(json_dict.get('folders', []))
+            folders.insert(0, 'root')
+            self._folders = folders
         self.__dict__.update(missing)
     #----------------------------------------------------------------------
     @property
@@ -140,6 +144,37 @@ class Catalog(BaseServer):
                 ), connection=self._con))
         return layers
     #----------------------------------------------------------------------
+    def crawl(self, max_workers=8):
+        """
+        Lists the services of every folder. The folder listings are read
+        concurrently with at most max_workers requests in flight.
+
+        Inputs:
+           max_workers - the number of folder listings read at once
+        Output:
+           list of dictionaries with the keys: folder, name, type and url
+        """
+        params = {"f" : "json"}
+        def _list(folder):
+            if folder == 'root':
+                url = self.root
+            else:
+                url = "%s/%s" % (self.root, folder)
+            return url, self._con.get(path=url, params=params)
+        inventory = []
+        for _, (url, res) in imap(_list, self.folders,
+                                  max_workers=max_workers):
+            for service in res.get('services', []):
+                # service names in a folder listing include the folder
+                inventory.append({
+                    "folder" : service['name'].rsplit('/', 1)[0] \
+                    if '/' in service['name'] else 'root',
+                    "name" : service['name'],
+                    "type" : service['type'],
+                    "url" : "%s/%s/%s" % (self.root, service['name'],
+                                          service['type'])})
+        return inventory
+    #----------------------------------------------------------------------
     @property
     def folders(self):
         """returns the folders on server"""
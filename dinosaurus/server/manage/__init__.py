@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 from .administration import AGSAdministration
 from .parameters import ClusterProtocol, Extension
+from ._logindex import LogIndex
+from ._advisor import PoolAdvisor
 
 __version__ = "4.0.0"
-__all__ = ['AGSAdministration', 'ClusterProtocol', 'Extension']
\ No newline at end of file
+__all__ = ['AGSAdministration', 'ClusterProtocol', 'Extension', 'LogIndex', 'PoolAdvisor']
\ No newline at end of file
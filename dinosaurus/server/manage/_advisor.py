@@ -0,0 +1,216 @@
+"""
+Recommends service instance pool sizes from the statistics ArcGIS Server
+records for each service.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import json
+import math
+import time
+from ...common._parallel import imap
+#----------------------------------------------------------------------
+def _machines(stats):
+    """returns the per machine statistics, or the summary as one machine"""
+    machines = [m for m in stats.get('perMachine', [])
+                if m.get('isStatisticsAvailable', True)]
+    if machines:
+        return machines
+    return [stats.get('summary', stats)]
+#----------------------------------------------------------------------
+def _service_name(service):
+    """returns <folder>/<name>.<type> of an AGSService"""
+    name = service.url.rstrip('/').split('/')
+    if len(name) > 1 and name[-2].lower() != 'services':
+        return "/".join(name[-2:])
+    return name[-1]
+########################################################################
+class PoolAdvisor(object):
+    """
+    Samples the statistics of services over a window of time and
+    recommends minInstancesPerNode, maxInstancesPerNode and maxWaitTime
+    for each of them.
+
+    The statistics resource reports the busy, free and maximum instances
+    and the transactions of a service, but not the time requests waited
+    for an instance. A service is treated as saturated when all of the
+    instances of a machine are busy.
+
+    Inputs:
+       services - list of AGSService objects, ex: Services.services
+       max_workers - the number of statistics requests kept in flight
+       headroom - the share of instances kept above the peak load
+       wait_factor - the number of average transactions a request may wait
+       min_wait - the smallest recommended maxWaitTime in seconds
+       max_wait - the largest recommended maxWaitTime in seconds
+    """
+    _services = None
+    _samples = None
+    max_workers = None
+    headroom = None
+    wait_factor = None
+    min_wait = None
+    max_wait = None
+    #----------------------------------------------------------------------
+    def __init__(self, services, max_workers=8, headroom=1.25,
+                 wait_factor=4, min_wait=60, max_wait=600):
+        """Constructor"""
+        self._services = list(services)
+        self._samples = dict((s.url, []) for s in self._services)
+        self.max_workers = max_workers
+        self.headroom = headroom
+        self.wait_factor = wait_factor
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+    #----------------------------------------------------------------------
+    def sample(self, window=300, interval=10):
+        """
+        Reads the statistics of every service every interval seconds for
+        window seconds, so window / interval + 1 samples are taken. The
+        statistics of the services are read concurrently. Samples are
+        added to the ones already taken.
+
+        Inputs:
+           window - the number of seconds to sample for
+           interval - the number of seconds between two samples
+        Output:
+           the number of rounds taken
+        """
+        rounds = int(window // interval) + 1
+        for count in range(rounds):
+            start = time.time()
+            for index, stats in imap(lambda s: s.statistics, self._services,
+                                     max_workers=self.max_workers,
+                                     return_exceptions=True):
+                if isinstance(stats, dict) and 'error' not in stats:
+                    stats['sampled'] = start
+                    self._samples[self._services[index].url].append(stats)
+            if count < rounds - 1:
+                time.sleep(max(0, interval - (time.time() - start)))
+        return rounds
+    #----------------------------------------------------------------------
+    @property
+    def samples(self):
+        """returns the statistics sampled for each service url"""
+        return self._samples
+    #----------------------------------------------------------------------
+    def clear(self):
+        """removes the samples"""
+        self._samples = dict((s.url, []) for s in self._services)
+    #----------------------------------------------------------------------
+    def _recommend(self, service, samples):
+        """builds the recommendation of a single service"""
+        busy = []
+        saturated = 0
+        for stats in samples:
+            machines = _machines(stats)
+            busy.extend(m.get('busy', 0) or 0 for m in machines)
+            if any(m.get('max', 0) and \
+                   (m.get('busy', 0) or 0) >= m.get('max', 0)
+                   for m in machines):
+                saturated += 1
+        first = samples[0].get('summary', samples[0])
+        last = samples[-1].get('summary', samples[-1])
+        transactions = (last.get('transactions', 0) or 0) - \
+            (first.get('transactions', 0) or 0)
+        busy_time = (last.get('totalBusyTime', 0) or 0) - \
+            (first.get('totalBusyTime', 0) or 0)
+        if transactions <= 0:
+            # a single sample, or the counters were reset by a restart
+            transactions = last.get('transactions', 0) or 0
+            busy_time = last.get('totalBusyTime', 0) or 0
+        avg_time = busy_time / float(transactions) if transactions else None
+        current = {"minInstancesPerNode" : service.minInstancesPerNode,
+                   "maxInstancesPerNode" : service.maxInstancesPerNode,
+                   "maxWaitTime" : service.maxWaitTime}
+        peak = max(busy) if busy else 0
+        mean = sum(busy) / float(len(busy)) if busy else 0
+        saturation = saturated / float(len(samples))
+        current_max = current['maxInstancesPerNode'] or 1
+        if saturation > 0:
+            # the real demand is hidden above the current maximum
+            new_max = max(current_max + 1,
+                          int(math.ceil(current_max * self.headroom)))
+        else:
+            new_max = max(1, int(math.ceil(peak * self.headroom)))
+        new_min = min(new_max, max(1, int(math.ceil(mean))))
+        if avg_time is None:
+            new_wait = current['maxWaitTime']
+        else:
+            new_wait = int(math.ceil(avg_time / 1000.0 * self.wait_factor))
+            new_wait = min(self.max_wait, max(self.min_wait, new_wait))
+        recommended = {"minInstancesPerNode" : new_min,
+                       "maxInstancesPerNode" : new_max,
+                       "maxWaitTime" : new_wait}
+        return {"name" : _service_name(service),
+                "url" : service.url,
+                "samples" : len(samples),
+                "peakBusy" : peak,
+                "meanBusy" : mean,
+                "saturation" : saturation,
+                "avgTime" : avg_time,
+                "current" : current,
+                "recommended" : recommended,
+                "changed" : recommended != current}
+    #----------------------------------------------------------------------
+    def recommend(self):
+        """
+        Returns the recommendation of every sampled service.
+
+        maxInstancesPerNode is the peak number of busy instances of a
+        machine plus the headroom. A saturated service gets its current
+        maximum plus the headroom instead, since its demand above the
+        maximum is not visible. minInstancesPerNode is the mean number of
+        busy instances. maxWaitTime is wait_factor times the average
+        transaction time, between min_wait and max_wait.
+
+        Output:
+           list of dictionaries with the keys: name, url, samples,
+           peakBusy, meanBusy, saturation (share of samples with every
+           instance of a machine busy), avgTime (milliseconds), current,
+           recommended and changed
+        """
+        pending = [s for s in self._services
+                   if self._samples[s.url] and s._json_dict is None]
+        for _ in imap(lambda s: s.init(), pending,
+                      max_workers=self.max_workers):
+            pass
+        return [self._recommend(s, self._samples[s.url])
+                for s in self._services if self._samples[s.url]]
+    #----------------------------------------------------------------------
+    def apply(self, recommendations=None, dry_run=True):
+        """
+        Edits the services whose recommended values differ from their
+        current ones. Editing a service restarts it.
+
+        Inputs:
+           recommendations - the result of recommend, default is a new
+             recommendation
+           dry_run - if True, only the changes are returned
+        Output:
+           list of dictionaries with the keys: name, changes ({property :
+           [current, recommended]}) and result (the edit response, None on
+           a dry run)
+        """
+        if recommendations is None:
+            recommendations = self.recommend()
+        services = dict((s.url, s) for s in self._services)
+        report = []
+        for rec in recommendations:
+            if not rec['changed']:
+                continue
+            changes = dict((k, [rec['current'][k], v])
+                           for k, v in rec['recommended'].items()
+                           if rec['current'][k] != v)
+            result = None
+            if dry_run == False:
+                service = services[rec['url']]
+                if service._json_dict is None:
+                    service.init()
+                props = json.loads(json.dumps(service._json_dict))
+                props.update(rec['recommended'])
+                result = service.edit(props)
+                service.init()
+            report.append({"name" : rec['name'],
+                           "changes" : changes,
+                           "result" : result})
+        return report
@@ -0,0 +1,262 @@
+"""
+A local SQLite index of ArcGIS Server log messages used to aggregate
+request times, error rates and slow operations per service.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import math
+import sqlite3
+import calendar
+import threading
+import itertools
+from datetime import datetime
+
+_COLUMNS = ("time", "type", "code", "source", "machine", "process",
+            "thread", "user", "method", "elapsed", "message")
+#----------------------------------------------------------------------
+def _to_ms(value):
+    """converts a datetime (UTC) to milliseconds since epoch"""
+    if isinstance(value, datetime):
+        return int(calendar.timegm(value.utctimetuple()) * 1000)
+    return value
+#----------------------------------------------------------------------
+def _elapsed(value):
+    """returns the elapsed seconds of a message or None"""
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+#----------------------------------------------------------------------
+def _row(message):
+    """converts a log message dictionary into a table row"""
+    return (message.get('time'),
+            message.get('type'),
+            message.get('code'),
+            message.get('source'),
+            message.get('machine'),
+            message.get('process'),
+            message.get('thread'),
+            message.get('user'),
+            message.get('methodName'),
+            _elapsed(message.get('elapsed')),
+            message.get('message'))
+#----------------------------------------------------------------------
+def _percentile(values, pct):
+    """returns the nearest rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+########################################################################
+class LogIndex(object):
+    """
+    Stores log messages in a SQLite file indexed on time, service,
+    machine and code, and answers aggregate questions about them.
+    Messages are usually streamed from Log.query_iter or Log.follow, ex:
+
+        index = LogIndex("logs.db")
+        index.ingest(log.query_iter(level="FINE", endTime=yesterday))
+        index.latency()
+
+    The same message ingested twice is only stored once.
+
+    Inputs:
+       path - the SQLite file, created when it does not exist. Use
+        ":memory:" for an index that is not saved.
+    """
+    _path = None
+    _con = None
+    _lock = None
+    #----------------------------------------------------------------------
+    def __init__(self, path=":memory:"):
+        """Constructor"""
+        self._path = path
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False)
+        if path != ":memory:":
+            self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("CREATE TABLE IF NOT EXISTS messages ("
+                          "time INTEGER, type TEXT, code INTEGER, "
+                          "source TEXT, machine TEXT, process TEXT, "
+                          "thread TEXT, user TEXT, method TEXT, "
+                          "elapsed REAL, message TEXT, "
+                          "UNIQUE (time, machine, process, thread, "
+                          "code, message))")
+        self._con.execute("CREATE INDEX IF NOT EXISTS messages_time "
+                          "ON messages (time)")
+        for column in ("source", "machine", "code"):
+            self._con.execute("CREATE INDEX IF NOT EXISTS messages_%s "
+                              "ON messages (%s, time)" % (column, column))
+    #----------------------------------------------------------------------
+    def ingest(self, messages, batch_size=5000):
+        """
+        Adds log messages to the index. The messages are read lazily and
+        written batch_size at a time, so any number of them can be
+        ingested with constant memory.
+
+        Inputs:
+           messages - an iterable of log message dictionaries
+           batch_size - the number of messages written per transaction
+        Output:
+           the number of messages added
+        """
+        added = 0
+        messages = iter(messages)
+        sql = "INSERT OR IGNORE INTO messages (%s) VALUES (%s)" % \
+            (", ".join(_COLUMNS), ", ".join(["?"] * len(_COLUMNS)))
+        while True:
+            rows = [_row(m) for m in itertools.islice(messages, batch_size)]
+            if not rows:
+                return added
+            with self._lock:
+                before = self._con.total_changes
+                self._con.execute("BEGIN")
+                try:
+                    self._con.executemany(sql, rows)
+                    self._con.execute("COMMIT")
+                except Exception:
+                    self._con.execute("ROLLBACK")
+                    raise
+                added += self._con.total_changes - before
+    #----------------------------------------------------------------------
+    def _where(self, service=None, startTime=None, endTime=None,
+               extra=None):
+        """builds the WHERE clause shared by the aggregate queries"""
+        clauses = []
+        args = []
+        if service is not None:
+            clauses.append("source = ?")
+            args.append(service)
+        if startTime is not None:
+            clauses.append("time >= ?")
+            args.append(_to_ms(startTime))
+        if endTime is not None:
+            clauses.append("time <= ?")
+            args.append(_to_ms(endTime))
+        if extra is not None:
+            clauses.append(extra)
+        if not clauses:
+            return "", args
+        return "WHERE " + " AND ".join(clauses), args
+    #----------------------------------------------------------------------
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._con.execute(sql, args).fetchall()
+    #----------------------------------------------------------------------
+    def latency(self, service=None, startTime=None, endTime=None,
+                interval=3600):
+        """
+        Returns the p50, p95 and p99 elapsed time of the requests of each
+        service for every interval. Only the messages that record an
+        elapsed time (FINE and more detailed levels) are counted.
+
+        Inputs:
+           service - optional service (log source) name, ex:
+            SampleWorldCities.MapServer
+           startTime - optional oldest time, datetime or milliseconds
+           endTime - optional most recent time, datetime or milliseconds
+           interval - the length of a period in seconds, default one hour
+        Output:
+           list of dictionaries with the keys: service, period (start of
+           the interval in milliseconds), count, p50, p95, p99 and max
+        """
+        where, args = self._where(service, startTime, endTime,
+                                  "elapsed IS NOT NULL")
+        step = int(interval * 1000)
+        results = []
+        with self._lock:
+            # the rows are read one group at a time, not all at once
+            rows = self._con.execute(
+                "SELECT source, (time / %d) * %d AS period, elapsed "
+                "FROM messages %s ORDER BY source, period, elapsed" %
+                (step, step, where), args)
+            for (source, period), group in itertools.groupby(
+                rows, key=lambda r: (r[0], r[1])):
+                values = [r[2] for r in group]
+                results.append({"service" : source,
+                                "period" : period,
+                                "count" : len(values),
+                                "p50" : _percentile(values, 50),
+                                "p95" : _percentile(values, 95),
+                                "p99" : _percentile(values, 99),
+                                "max" : values[-1]})
+        return results
+    #----------------------------------------------------------------------
+    def error_rate(self, service=None, startTime=None, endTime=None,
+                   interval=3600, levels=("SEVERE",)):
+        """
+        Returns the share of the messages of each service and interval
+        that are errors.
+
+        Inputs:
+           service - optional service (log source) name
+           startTime - optional oldest time, datetime or milliseconds
+           endTime - optional most recent time, datetime or milliseconds
+           interval - the length of a period in seconds, default one hour
+           levels - the message types counted as errors
+        Output:
+           list of dictionaries with the keys: service, period, total,
+           errors and rate
+        """
+        where, args = self._where(service, startTime, endTime)
+        step = int(interval * 1000)
+        marks = ", ".join(["?"] * len(levels))
+        rows = self._execute(
+            "SELECT source, (time / %d) * %d AS period, COUNT(*), "
+            "SUM(CASE WHEN type IN (%s) THEN 1 ELSE 0 END) "
+            "FROM messages %s GROUP BY source, period "
+            "ORDER BY source, period" % (step, step, marks, where),
+            list(levels) + args)
+        return [{"service" : source,
+                 "period" : period,
+                 "total" : total,
+                 "errors" : errors,
+                 "rate" : errors / float(total) if total else 0.0}
+                for source, period, total, errors in rows]
+    #----------------------------------------------------------------------
+    def slow_operations(self, limit=10, service=None, startTime=None,
+                        endTime=None):
+        """
+        Returns the operations with the highest average elapsed time.
+
+        Inputs:
+           limit - the number of operations returned
+           service - optional service (log source) name
+           startTime - optional oldest time, datetime or milliseconds
+           endTime - optional most recent time, datetime or milliseconds
+        Output:
+           list of dictionaries with the keys: service, method, count,
+           average, max and total, slowest first
+        """
+        where, args = self._where(service, startTime, endTime,
+                                  "elapsed IS NOT NULL")
+        rows = self._execute(
+            "SELECT source, method, COUNT(*), AVG(elapsed), MAX(elapsed), "
+            "SUM(elapsed) FROM messages %s GROUP BY source, method "
+            "ORDER BY AVG(elapsed) DESC LIMIT ?" % where, args + [limit])
+        return [{"service" : source,
+                 "method" : method,
+                 "count" : count,
+                 "average" : average,
+                 "max" : maximum,
+                 "total" : total}
+                for source, method, count, average, maximum, total in rows]
+    #----------------------------------------------------------------------
+    @property
+    def count(self):
+        """returns the number of messages in the index"""
+        return self._execute("SELECT COUNT(*) FROM messages")[0][0]
+    #----------------------------------------------------------------------
+    @property
+    def time_range(self):
+        """returns the oldest and most recent message times"""
+        return tuple(self._execute(
+            "SELECT MIN(time), MAX(time) FROM messages")[0])
+    #----------------------------------------------------------------------
+    def close(self):
+        """closes the database"""
+        with self._lock:
+            self._con.close()
@@ -2,7 +2,37 @@ from __future__ import absolute_import
 from __future__ import print_function
 from ...common._base import BaseServer
 from datetime import datetime
+import os
 import csv
+import json
+import time
+import six
+#----------------------------------------------------------------------
+def _message_key(message):
+    """returns the values that identify a log message"""
+    return (message.get('time'), message.get('machine'),
+            message.get('process'), message.get('thread'),
+            message.get('code'), message.get('message'))
+#----------------------------------------------------------------------
+def _read_cursor(path):
+    """returns the time and message keys saved in a cursor file"""
+    if path is None or os.path.isfile(path) == False:
+        return None, set()
+    with open(path, 'r') as f:
+        cursor = json.load(f)
+    return cursor.get('time', None), \
+           set(tuple(k) for k in cursor.get('keys', []))
+#----------------------------------------------------------------------
+def _write_cursor(path, last_time, keys):
+    """saves the time of the newest message, and the messages logged at
+    that time, so a restarted follow resumes where it stopped"""
+    tmp = "%s.tmp" % path
+    with open(tmp, 'w') as f:
+        json.dump({"time" : last_time,
+                   "keys" : [list(k) for k in keys]}, f)
+    if os.path.isfile(path):
+        os.remove(path)
+    os.rename(tmp, path)
 ########################################################################
 class Log(BaseServer):
     """ Log of a server """
@@ -116,26 +146,18 @@ class Log(BaseServer):
         return self._con.post(path=url,
                               postdata=currentSettings)
     #----------------------------------------------------------------------
-    def query(self,
-              startTime=None,
-              endTime=None,
-              sinceServerStart=False,
-              level="WARNING",
-              services="*",
-              machines="*",
-              server="*",
-              codes=None,
-              processIds=None,
-              export=False,
-              exportType="CSV", #CSV or TAB
-              out_path=None
-              ):
-        """
-           The query operation on the logs resource provides a way to
-           aggregate, filter, and page through logs across the entire site.
-           Inputs:
-
-        """
+    def _query_params(self,
+                      startTime=None,
+                      endTime=None,
+                      sinceServerStart=False,
+                      level="WARNING",
+                      services="*",
+                      machines="*",
+                      server="*",
+                      codes=None,
+                      processIds=None,
+                      pageSize=10000):
+        """builds the parameters of a log query"""
         if codes is None:
             codes = []
         if processIds is None:
@@ -154,15 +176,18 @@ class Log(BaseServer):
         params = {
             "f" : "json",
             "sinceServerStart" : sinceServerStart,
-            "pageSize" : 10000
+            "pageSize" : pageSize
         }
-        url = "{url}/query".format(url=self._url)
         if startTime is not None and \
            isinstance(startTime, datetime):
             params['startTime'] = startTime.strftime("%Y-%m-%dT%H:%M:%S")
+        elif startTime is not None:
+            params['startTime'] = startTime
         if endTime is not None and \
            isinstance(endTime, datetime):
             params['endTime'] = endTime.strftime("%Y-%m-%dT%H:%M:%S")
+        elif endTime is not None:
+            params['endTime'] = endTime
         if level.upper() in allowed_levels:
             params['level'] = level
         if server != "*":
@@ -172,25 +197,196 @@ class Log(BaseServer):
         if machines != "*":
             qFilter['machines'] = machines.split(",")
         params['filter'] = qFilter
+        return params
+    #----------------------------------------------------------------------
+    def query_iter(self,
+                   startTime=None,
+                   endTime=None,
+                   sinceServerStart=False,
+                   level="WARNING",
+                   services="*",
+                   machines="*",
+                   server="*",
+                   codes=None,
+                   processIds=None,
+                   pageSize=10000):
+        """
+           Returns every log message matching the query, newest first, by
+           following the hasMore/endTime paging of the query operation.
+           Only one page is held in memory at a time.
+           Inputs:
+              startTime - the most recent time to query, as a datetime or
+                          milliseconds since epoch. Default is now.
+              endTime - the oldest time to query, as a datetime or
+                        milliseconds since epoch
+              sinceServerStart - only return the logs since the server
+                                 started
+              level - the lowest level of the messages returned
+              services - comma delimited services to query, * is all
+              machines - comma delimited machines to query, * is all
+              server - comma delimited server components, * is all
+              codes - list of message codes
+              processIds - list of process ids
+              pageSize - the number of messages requested per call
+           Output:
+              generator of log message dictionaries
+        """
+        url = "{url}/query".format(url=self._url)
+        params = self._query_params(startTime=startTime, endTime=endTime,
+                                    sinceServerStart=sinceServerStart,
+                                    level=level, services=services,
+                                    machines=machines, server=server,
+                                    codes=codes, processIds=processIds,
+                                    pageSize=pageSize)
+        seen = set()
+        while True:
+            res = self._con.post(path=url,
+                                 postdata=params)
+            if not isinstance(res, dict) or 'logMessages' not in res:
+                raise Exception("Could not query the logs: %s" % res)
+            boundary = res.get('endTime', None)
+            page_seen = set()
+            for message in res['logMessages']:
+                key = _message_key(message)
+                if key in seen:
+                    continue
+                if message.get('time') == boundary:
+                    page_seen.add(key)
+                yield message
+            if not res.get('hasMore', False) or \
+               boundary is None or \
+               boundary == params.get('startTime', None):
+                return
+            # the next page starts at the oldest time of this one, so the
+            # messages logged at that exact time are skipped once seen
+            seen = page_seen
+            params['startTime'] = boundary
+    #----------------------------------------------------------------------
+    def follow(self,
+               level="WARNING",
+               services="*",
+               machines="*",
+               server="*",
+               codes=None,
+               processIds=None,
+               cursor_path=None,
+               min_interval=1,
+               max_interval=60,
+               pageSize=10000):
+        """
+           Tails the logs of the site. Yields the messages logged after the
+           last one returned, oldest first, and keeps polling forever.
+           The wait between polls is min_interval after a poll that found
+           messages and doubles, up to max_interval, while the logs are
+           idle. When cursor_path is given, the position is saved to that
+           JSON file after every poll so a restarted follow does not
+           return the same messages again.
+           Inputs:
+              level - the lowest level of the messages returned
+              services - comma delimited services to query, * is all
+              machines - comma delimited machines to query, * is all
+              server - comma delimited server components, * is all
+              codes - list of message codes
+              processIds - list of process ids
+              cursor_path - optional JSON file that stores the position
+              min_interval - the shortest wait, in seconds, between polls
+              max_interval - the longest wait, in seconds, between polls
+              pageSize - the number of messages requested per call
+           Output:
+              generator of log message dictionaries
+        """
+        query = dict(level=level, services=services, machines=machines,
+                     server=server, codes=codes, processIds=processIds)
+        last_time, last_keys = _read_cursor(cursor_path)
+        if last_time is None:
+            # start after the newest message already logged
+            for message in self.query_iter(pageSize=1, **query):
+                last_time = message.get('time')
+                last_keys = set([_message_key(message)])
+                break
+        wait = min_interval
+        while True:
+            messages = []
+            for message in self.query_iter(endTime=last_time,
+                                           pageSize=pageSize, **query):
+                if _message_key(message) not in last_keys:
+                    messages.append(message)
+            if messages:
+                newest = messages[0].get('time')
+                if newest == last_time:
+                    last_keys.update(_message_key(m) for m in messages)
+                else:
+                    last_time = newest
+                    last_keys = set(_message_key(m) for m in messages
+                                    if m.get('time') == newest)
+                if cursor_path is not None:
+                    _write_cursor(cursor_path, last_time, last_keys)
+                for message in reversed(messages):
+                    yield message
+                wait = min_interval
+            else:
+                time.sleep(wait)
+                wait = min(wait * 2, max_interval)
+    #----------------------------------------------------------------------
+    def query(self,
+              startTime=None,
+              endTime=None,
+              sinceServerStart=False,
+              level="WARNING",
+              services="*",
+              machines="*",
+              server="*",
+              codes=None,
+              processIds=None,
+              export=False,
+              exportType="CSV", #CSV or TAB
+              out_path=None
+              ):
+        """
+           The query operation on the logs resource provides a way to
+           aggregate, filter, and page through logs across the entire site.
+           When export is True, every page of matching messages is written
+           to out_path as it arrives and the path is returned.
+           Inputs:
+              see query_iter
+              export - if True, the messages are written to out_path
+              exportType - CSV or TAB
+              out_path - the file to write the messages to
+        """
         if export == True and \
            out_path is not None:
-
-            messages = self._con.post(path=url,
-                                      postdata=params)
-            with open(name=out_path, mode='wb') as f:
-                hasKeys = False
-                if exportType == "TAB":
-                    csvwriter = csv.writer(f, delimiter='\t')
-                else:
-                    csvwriter = csv.writer(f)
-                for message in messages['logMessages']:
-                    if hasKeys == False:
-                        csvwriter.writerow(message.keys())
-                        hasKeys = True
-                    csvwriter.writerow(message.values())
-                    del message
-            del messages
+            messages = self.query_iter(startTime=startTime,
+                                       endTime=endTime,
+                                       sinceServerStart=sinceServerStart,
+                                       level=level, services=services,
+                                       machines=machines, server=server,
+                                       codes=codes, processIds=processIds)
+            if six.PY2:
+                f = open(out_path, 'wb')
+            else:
+                f = open(out_path, 'w', newline='')
+            with f:
+                csvwriter = None
+                for message in messages:
+                    if csvwriter is None:
+                        fields = list(message.keys())
+                        if exportType == "TAB":
+                            csvwriter = csv.DictWriter(f, fieldnames=fields,
+                                                       delimiter='\t',
+                                                       extrasaction='ignore')
+                        else:
+                            csvwriter = csv.DictWriter(f, fieldnames=fields,
+                                                       extrasaction='ignore')
+                        csvwriter.writeheader()
+                    csvwriter.writerow(message)
             return out_path
         else:
+            url = "{url}/query".format(url=self._url)
+            params = self._query_params(startTime=startTime,
+                                        endTime=endTime,
+                                        sinceServerStart=sinceServerStart,
+                                        level=level, services=services,
+                                        machines=machines, server=server,
+                                        codes=codes, processIds=processIds)
             return self._con.post(path=url,
-                                  postdata=params)
\ No newline at end of file
+                                  postdata=params)
@@ -1,9 +1,11 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from ...common._base import BaseServer
+from ...common._parallel import imap
 from .parameters import Extension
 import os
 import json
+import time
 import tempfile
 ########################################################################
 class Services(BaseServer):
@@ -20,6 +22,7 @@ class Services(BaseServer):
     _description = None
     _isDefault = None
     _services = None
+    _service_handles = None
     _json = None
     #----------------------------------------------------------------------
     def __init__(self, url, connection,
@@ -130,23 +133,169 @@ class Services(BaseServer):
     #----------------------------------------------------------------------
     @property
     def services(self):
-        """ returns the services in the current folder """
-        self._services = []
-        params = {
-                    "f" : "json"
-                }
-        json_dict = self._con.get(path=self._currentURL,
-                                 params=params)
-        if "services" in json_dict.keys():
-            for s in json_dict['services']:
+        """
+        returns the services in the current folder. The services are
+        built from the folder listing and only request their full
+        properties when one that is not in the listing is read, see
+        hydrate. The list is kept per folder until refresh is called.
+        """
+        if self._service_handles is None:
+            self._service_handles = {}
+        if self._currentURL not in self._service_handles:
+            if self._services is None:
+                self.init()
+            handles = []
+            for s in self._services or []:
                 uURL = self._currentURL + "/%s.%s" % (s['serviceName'], s['type'])
-                self._services.append(
-                    AGSService(url=uURL,
-                               connection=self._con)
-                )
-        return self._services
+                handles.append(AGSService(url=uURL,
+                                          connection=self._con,
+                                          properties=s))
+            self._service_handles[self._currentURL] = handles
+        return self._service_handles[self._currentURL]
+    #----------------------------------------------------------------------
+    def hydrate(self, services=None, max_workers=8):
+        """
+        Loads the full properties of many services at once, with at most
+        max_workers requests in flight. Services already loaded are not
+        requested again.
+
+        Inputs:
+           services - list of AGSService objects, default is the services
+             of the current folder
+           max_workers - the number of services loaded at once
+        Output:
+           the list of services
+        """
+        if services is None:
+            services = self.services
+        pending = [s for s in services if s._json_dict is None]
+        for _ in imap(lambda service: service.init(), pending,
+                      max_workers=max_workers):
+            pass
+        return services
+    #----------------------------------------------------------------------
+    def refresh(self):
+        """reloads the folder and drops the cached services"""
+        self._service_handles = None
+        self.init()
     #----------------------------------------------------------------------
-    def find_services(self, service_type="*"):
+    def crawl(self, max_workers=8, snapshot=None):
+        """
+        Lists every service of the site. The folder listings are read
+        concurrently with at most max_workers requests in flight.
+
+        Inputs:
+           max_workers - the number of folder listings read at once
+           snapshot - optional JSON file the inventory is saved to
+        Output:
+           list of service dictionaries as returned by the folder
+           listings (folderName, serviceName, type, description) with the
+           admin URL of the service added as URL
+        """
+        params = {
+            "f" : "json"
+        }
+        root = self._con.get(path=self._url, params=params)
+        folders = [f for f in root.get('folders', [])
+                   if f not in ("", "/")]
+        listings = [("", root)]
+        def _list(folder):
+            return folder, self._con.get(path=self._url + "/%s" % folder,
+                                         params=params)
+        for _, listing in imap(_list, folders, max_workers=max_workers):
+            listings.append(listing)
+        inventory = []
+        for folder, res in listings:
+            if folder == "":
+                url = self._url
+            else:
+                url = self._url + "/%s" % folder
+            for service in res.get('services', []):
+                service['URL'] = url + "/%s.%s" % (service['serviceName'],
+                                                   service['type'])
+                inventory.append(service)
+        if snapshot is not None:
+            with open(snapshot, 'w') as f:
+                json.dump({"url" : self._url,
+                           "created" : int(time.time() * 1000),
+                           "folders" : folders,
+                           "services" : inventory}, f)
+        return inventory
+    #----------------------------------------------------------------------
+    def sweep(self, status=True, statistics=True, max_workers=16,
+              inventory=None):
+        """
+        Reads the status and the statistics of every service of the site
+        concurrently, with at most max_workers requests in flight.
+
+        Inputs:
+           status - if True, the configured and real time states are read
+           statistics - if True, the instance and transaction statistics
+             are read
+           max_workers - the number of requests kept in flight
+           inventory - optional result of crawl. Pass it when sweeping on
+             a schedule so the folders are not listed again every time.
+        Output:
+           list of dictionaries, one per service, with the keys: name
+           (<folder>/<name>.<type>), configuredState, realTimeState, max,
+           busy, free, transactions, avgTime (milliseconds per
+           transaction) and error
+        """
+        if inventory is None:
+            inventory = self.crawl(max_workers=max_workers)
+        params = {
+            "f" : "json"
+        }
+        kinds = []
+        if status:
+            kinds.append("status")
+        if statistics:
+            kinds.append("statistics")
+        tasks = [(index, kind) for index in range(len(inventory))
+                 for kind in kinds]
+        def _fetch(task):
+            index, kind = task
+            return self._con.get(path=inventory[index]['URL'] + "/" + kind,
+                                 params=params)
+        rows = []
+        for service in inventory:
+            folder = service.get('folderName', '/')
+            name = "%s.%s" % (service['serviceName'], service['type'])
+            if folder not in (None, "", "/"):
+                name = "%s/%s" % (folder, name)
+            rows.append({"name" : name,
+                         "configuredState" : None,
+                         "realTimeState" : None,
+                         "max" : None,
+                         "busy" : None,
+                         "free" : None,
+                         "transactions" : None,
+                         "avgTime" : None,
+                         "error" : None})
+        for position, res in imap(_fetch, tasks, max_workers=max_workers,
+                                  ordered=False, return_exceptions=True):
+            index, kind = tasks[position]
+            row = rows[index]
+            if isinstance(res, Exception) or \
+               not isinstance(res, dict) or \
+               'error' in res or res.get('status', None) == 'error':
+                row['error'] = str(res)
+            elif kind == "status":
+                row['configuredState'] = res.get('configuredState', None)
+                row['realTimeState'] = res.get('realTimeState', None)
+            else:
+                summary = res.get('summary', res)
+                transactions = summary.get('transactions', None)
+                row['max'] = summary.get('max', None)
+                row['busy'] = summary.get('busy', None)
+                row['free'] = summary.get('free', None)
+                row['transactions'] = transactions
+                if transactions:
+                    row['avgTime'] = summary.get('totalBusyTime', 0) / \
+                        float(transactions)
+        return rows
+    #----------------------------------------------------------------------
+    def find_services(self, service_type="*", max_workers=8):
         """
             returns a list of a particular service type on AGS
             Input:
@@ -156,8 +305,10 @@ class Services(BaseServer):
                              "SEARCHSERVER", "GEODATASERVER",
                              "GEOCODESERVER", "*").  The default is *
                              meaning find all service names.
+              max_workers - the number of folder listings read at once
             Output:
-              returns a list of service names as <folder>/<name>.<type>
+              returns a list of service dictionaries with the admin URL
+              of each service
         """
         allowed_service_types = ("GPSERVER", "GLOBESERVER", "MAPSERVER",
                                  "GEOMETRYSERVER", "IMAGESERVER",
@@ -167,29 +318,9 @@ class Services(BaseServer):
         for v in lower_types:
             if v.upper() not in allowed_service_types:
                 return {"message" : "%s is not an allowed service type." % v}
-        params = {
-            "f" : "json"
-        }
-        type_services = []
-        folders = self.folders
-        folders.append("")
-        baseURL = self._url
-        for folder in folders:
-            if folder == "":
-                url = baseURL
-            else:
-                url = baseURL + "/%s" % folder
-            res = self._con.get(path=url, params=params)
-            if 'services' in res:
-                for service in res['services']:
-                    if service['type'].lower() in lower_types:
-                        service['URL'] = url + "/%s.%s" % (service['serviceName'],
-                                                           service_type)
-                        type_services.append(service)
-                    del service
-            del res
-            del folder
-        return type_services
+        return [service for service in self.crawl(max_workers=max_workers)
+                if "*" in lower_types or \
+                service['type'].lower() in lower_types]
     #----------------------------------------------------------------------
     def addFolderPermission(self, principal, isAllowed=True, folder=None):
         """
@@ -298,6 +429,8 @@ class Services(BaseServer):
         params = {
             "f" : "json"
         }
+        self._service_handles = None
+        self._services = None
         return self._con.post(path=uURL, postdata=params)
     #----------------------------------------------------------------------
     def service_report(self, folder=None):
@@ -352,6 +485,8 @@ class Services(BaseServer):
             uURL = self._url + "/renameService"
         else:
             uURL = self._url + "/%s/renameService" % folder
+        self._service_handles = None
+        self._services = None
         return self._con.post(path=uURL, postdata=params)
     #----------------------------------------------------------------------
     def createService(self, service):
@@ -367,6 +502,8 @@ class Services(BaseServer):
             params['service'] = service
         elif isinstance(service, dict):
             params['service'] = json.dumps(service)
+        self._service_handles = None
+        self._services = None
         return self._con.post(path=url,
                              postdata=params)
     #----------------------------------------------------------------------
@@ -442,6 +579,190 @@ class Services(BaseServer):
         return self._con.post(path=url,
                              postdata=params)
     #----------------------------------------------------------------------
+    def _service_entry(self, service):
+        """
+        returns the folderName, serviceName, type and admin URL of an
+        AGSService, a crawl entry or a stopServices style dictionary
+        """
+        if isinstance(service, AGSService):
+            folder = service.folderName
+            name = service.serviceName
+            service_type = service.type
+            url = service.url
+        else:
+            folder = service.get('folderName', "")
+            name = service['serviceName']
+            service_type = service['type']
+            url = service.get('URL', None)
+        if folder in (None, "/"):
+            folder = ""
+        if url is None:
+            if folder == "":
+                url = self._url + "/%s.%s" % (name, service_type)
+            else:
+                url = self._url + "/%s/%s.%s" % (folder, name, service_type)
+        return {"folderName" : folder,
+                "serviceName" : name,
+                "type" : service_type,
+                "URL" : url}
+    #----------------------------------------------------------------------
+    def _wait_started(self, entries, timeout=600, poll_interval=2,
+                      max_poll_interval=15, max_workers=8):
+        """
+        polls the status of services until they are all STARTED or the
+        timeout is reached and returns the seconds each one took and the
+        services that did not start
+        """
+        params = {
+            "f" : "json"
+        }
+        start = time.time()
+        started = {}
+        pending = list(entries)
+        wait = poll_interval
+        while pending:
+            states = imap(lambda e: self._con.get(path=e['URL'] + "/status",
+                                                  params=params),
+                          pending, max_workers=max_workers,
+                          return_exceptions=True)
+            still_pending = []
+            for index, res in states:
+                entry = pending[index]
+                if isinstance(res, dict) and \
+                   res.get('realTimeState', None) == "STARTED":
+                    started[entry['URL']] = time.time() - start
+                else:
+                    still_pending.append(entry)
+            pending = still_pending
+            if not pending or time.time() - start + wait > timeout:
+                break
+            time.sleep(wait)
+            wait = min(wait * 2, max_poll_interval)
+        return started, pending
+    #----------------------------------------------------------------------
+    def rolling_restart(self, services=None, batch_size=None,
+                        per_machine=2, target_time=60, timeout=600,
+                        poll_interval=2, max_poll_interval=15,
+                        max_workers=8,
+                        exclude_folders=("System", "Utilities")):
+        """
+        Restarts services a batch at a time. Each batch is stopped and
+        started with stopServices and startServices, and the next batch
+        only begins once the status of every service of the batch is
+        STARTED.
+
+        The rollout stops at the first failed batch: when stopServices or
+        startServices returns an error, or when a service of the batch is
+        not STARTED after timeout seconds. The services of the later
+        batches are left untouched and listed in remaining.
+
+        The first batch has per_machine services for every machine of the
+        site. A batch that takes longer than target_time seconds to start
+        halves the size of the next one, and a batch that starts in less
+        than half of target_time grows it by one, never above the first
+        size.
+
+        Inputs:
+           services - list of AGSService objects, crawl entries or
+             stopServices style dictionaries. The default is every
+             service whose configured state is STARTED, outside of
+             exclude_folders.
+           batch_size - the largest number of services restarted at once,
+             default is per_machine times the number of machines
+           per_machine - the services restarted at once on each machine
+           target_time - the seconds a batch should take to start
+           timeout - the longest wait, in seconds, for a batch to start
+           poll_interval - the shortest wait, in seconds, between status
+             checks
+           max_poll_interval - the longest wait between status checks
+           max_workers - the number of status requests kept in flight
+           exclude_folders - folders skipped when services is None. The
+             System and Utilities services are only restarted when they
+             are listed in services.
+        Output:
+           dictionary with the keys: batches (list of dictionaries with
+           the keys: services, size, stopTime, startTime, readyTime,
+           failed and error), started (seconds each service took to be
+           STARTED, by service URL), failed (URLs of the services that did
+           not start), error (the error of the failed batch or None),
+           remaining (URLs of the services not restarted) and elapsed
+        """
+        begin = time.time()
+        if services is None:
+            inventory = self.crawl(max_workers=max_workers)
+            states = self.sweep(statistics=False, max_workers=max_workers,
+                                inventory=inventory)
+            services = [s for s, row in zip(inventory, states)
+                        if row['configuredState'] == "STARTED"]
+            excluded = [f.lower() for f in exclude_folders or []]
+            entries = [e for e in map(self._service_entry, services)
+                       if e['folderName'].lower() not in excluded]
+        else:
+            entries = [self._service_entry(s) for s in services]
+        if batch_size is None:
+            url = self._url.rsplit('/', 1)[0] + "/machines"
+            res = self._con.get(path=url, params={"f" : "json"})
+            machines = res.get('machines', []) if isinstance(res, dict) else []
+            batch_size = max(1, len(machines) * per_machine)
+        max_batch = batch_size
+        report = {"batches" : [], "started" : {}, "failed" : [],
+                  "error" : None, "remaining" : []}
+        position = 0
+        while position < len(entries):
+            batch = entries[position:position + batch_size]
+            position += len(batch)
+            services = [dict((k, e[k]) for k in
+                             ("folderName", "serviceName", "type"))
+                        for e in batch]
+            start = time.time()
+            error = None
+            res = self.stopServices(services)
+            if not isinstance(res, dict) or \
+               'error' in res or res.get('status', None) == 'error':
+                error = {"operation" : "stopServices", "response" : res}
+            stopped = time.time()
+            # the batch is started even when stopping it failed, so no
+            # service is left stopped
+            res = self.startServices(services)
+            if error is None and (not isinstance(res, dict) or \
+               'error' in res or res.get('status', None) == 'error'):
+                error = {"operation" : "startServices", "response" : res}
+            posted = time.time()
+            if error is not None and error['operation'] == "startServices":
+                # the services were never asked to start, there is nothing
+                # to wait for
+                started, failed = {}, list(batch)
+            else:
+                started, failed = self._wait_started(
+                    batch, timeout=timeout, poll_interval=poll_interval,
+                    max_poll_interval=max_poll_interval,
+                    max_workers=max_workers)
+            ready = time.time() - start
+            if error is None and failed:
+                message = "%s service(s) not STARTED after %ss" % \
+                    (len(failed), timeout)
+                error = {"operation" : "status", "response" : message}
+            report['started'].update(started)
+            report['failed'].extend(e['URL'] for e in failed)
+            report['batches'].append({
+                "services" : [e['URL'] for e in batch],
+                "size" : len(batch),
+                "stopTime" : stopped - start,
+                "startTime" : posted - stopped,
+                "readyTime" : ready,
+                "failed" : [e['URL'] for e in failed],
+                "error" : error})
+            if error is not None:
+                report['error'] = error
+                report['remaining'] = [e['URL'] for e in entries[position:]]
+                break
+            if ready > target_time:
+                batch_size = max(1, batch_size // 2)
+            elif ready < target_time / 2.0:
+                batch_size = min(max_batch, batch_size + 1)
+        report['elapsed'] = time.time() - begin
+        return report
+    #----------------------------------------------------------------------
     def editFolder(self, description, webEncrypted=False):
         """
         This operation allows you to change the description of an existing
@@ -528,22 +849,32 @@ class AGSService(BaseServer):
     _portalProperties = None
     _jsonProperties = None
     _url = None
+    _folderName = None
     #----------------------------------------------------------------------
     def __init__(self,
                  url,
                  connection,
-                 initialize=False):
+                 initialize=False,
+                 properties=None):
         """Constructor
             Inputs:
                url - admin url
                connection - SiteConnection object
                initialize - fills all the properties at object creation is
                             true
+               properties - optional entry of a folder listing. Its
+                            serviceName, type, description and folderName
+                            are used without loading the service.
         """
         super(AGSService, self).__init__(url,connection, initialize)
         self._url = url
         self._currentURL = url
         self._con = connection
+        if properties is not None:
+            self._serviceName = properties.get('serviceName', None)
+            self._type = properties.get('type', None)
+            self._description = properties.get('description', None)
+            self._folderName = properties.get('folderName', None)
         if initialize:
             self.init(connection)
     #----------------------------------------------------------------------
@@ -576,6 +907,17 @@ class AGSService(BaseServer):
             del k
             del v
     #----------------------------------------------------------------------
+    @property
+    def folderName(self):
+        """returns the folder of the service, / is the root folder"""
+        if self._folderName is None:
+            parts = self._url.rstrip('/').split('/')
+            if len(parts) > 1 and parts[-2].lower() != 'services':
+                self._folderName = parts[-2]
+            else:
+                self._folderName = "/"
+        return self._folderName
+    #----------------------------------------------------------------------
     def refreshProperties(self):
         """refreshes the object's values by re-querying the service"""
         self.init()
@@ -2,7 +2,67 @@ from __future__ import absolute_import
 from __future__ import print_function
 import six
 from ...common._base import BaseServer
+from ...common._cache import make_key
+from ...common._utils import create_uid
 import json
+import time
+try:
+    import numpy as np
+    hasNumPy = True
+except ImportError:
+    hasNumPy = False
+try:
+    import pandas as pd
+    hasPandas = True
+except ImportError:
+    hasPandas = False
+
+_DAY = 86400000
+_SINCE_SPANS = {"LAST_DAY" : _DAY, "LAST_WEEK" : 7 * _DAY,
+                "LAST_MONTH" : 30 * _DAY, "LAST_YEAR" : 365 * _DAY}
+#----------------------------------------------------------------------
+def _parse_report(res):
+    """
+    returns the time slices of a usage report data response and a
+    dictionary of (metric, resourceURI) -> list of values
+    """
+    if not isinstance(res, dict) or 'report' not in res:
+        raise Exception("Could not read the report data: %s" % res)
+    report = res['report']
+    slices = report.get('time-slices', [])
+    series = {}
+    for query in report.get('report-data', []):
+        if isinstance(query, dict):
+            query = [query]
+        for item in query:
+            metric = item.get('metric-type', item.get('metricType'))
+            series[(metric, item.get('resourceURI'))] = item.get('data', [])
+    return slices, series
+#----------------------------------------------------------------------
+def _build_frame(slices, series):
+    """
+    builds a pandas DataFrame indexed by time with a (metric,
+    resourceURI) column per series. Without pandas a dictionary of numpy
+    arrays is returned: {"time" : array, "metrics" : {metric :
+    {resourceURI : array}}}. Missing values are NaN.
+    """
+    keys = sorted(series.keys())
+    columns = [np.array([np.nan if v is None else v for v in series[k]],
+                        dtype=float) for k in keys]
+    if hasPandas:
+        if columns:
+            data = np.column_stack(columns)
+        else:
+            data = np.empty((len(slices), 0))
+        return pd.DataFrame(data,
+                            index=pd.to_datetime(slices, unit='ms'),
+                            columns=pd.MultiIndex.from_tuples(
+                                keys, names=["metric", "resourceURI"]))
+    frame = {"time" : np.array(slices, dtype='datetime64[ms]'),
+             "metrics" : {}}
+    for (metric, uri), values in zip(keys, columns):
+        frame['metrics'].setdefault(metric, {})[uri] = values
+    return frame
 ########################################################################
 class UsageReports(BaseServer):
     """
@@ -252,11 +312,14 @@ class UsageReport(BaseServer):
     _aggregationInterval = None
     _queries = None
     _metadata = None
+    _cache = None
+    _slices = None
     #----------------------------------------------------------------------
     def __init__(self, url, connection,
                  initialize=False):
         """Constructor"""
         super(UsageReport, self).__init__(url, connection, initialize)
+        self._slices = {}
         self._con = connection
         self._url = url
         if initialize:
@@ -414,4 +477,155 @@ class UsageReport(BaseServer):
         }
         url = self._url + "/data"
         return self._con.post(path=url,
-                              postdata=params)
\ No newline at end of file
+                              postdata=params)
+    #----------------------------------------------------------------------
+    @property
+    def cache(self):
+        """
+        gets/sets an optional SQLiteCache that keeps the closed time slices
+        read by to_frame, so other processes can reuse them
+        """
+        return self._cache
+    #----------------------------------------------------------------------
+    @cache.setter
+    def cache(self, value):
+        """gets/sets the time slice cache"""
+        self._cache = value
+    #----------------------------------------------------------------------
+    def _definition(self):
+        """
+        returns the queries, since, from, to and aggregationInterval
+        values of the report as saved on the server
+        """
+        if self._json_dict is None:
+            self.init()
+        report = self._json_dict if isinstance(self._json_dict, dict) else {}
+        return {"queries" : report.get('queries', None),
+                "since" : str(report.get('since', "")).upper(),
+                "from" : report.get('from', None),
+                "to" : report.get('to', None),
+                "aggregationInterval" : report.get('aggregationInterval',
+                                                   None)}
+    #----------------------------------------------------------------------
+    def _query_range(self, fromValue, toValue, interval, queryFilter):
+        """
+        reads the report data between two times (milliseconds). When the
+        range is inside the report's own time range, the report is
+        queried. Otherwise a temporary CUSTOM copy of the report is added,
+        queried and deleted.
+        """
+        definition = self._definition()
+        if definition['since'] == "CUSTOM":
+            first, last = definition['from'], definition['to']
+        elif definition['since'] in _SINCE_SPANS:
+            last = int(time.time() * 1000)
+            first = last - _SINCE_SPANS[definition['since']]
+        else:
+            first = last = None
+        if first is not None and last is not None and \
+           first <= fromValue and toValue <= last:
+            return self.query(queryFilter)
+        parent = self._url.rsplit('/', 1)[0]
+        name = "%s_%s" % (self.reportname, create_uid())
+        usagereport = {
+            "reportname" : name,
+            "queries" : self.queries,
+            "since" : "CUSTOM",
+            "from" : fromValue,
+            "to" : toValue,
+            "aggregationInterval" : int(interval // 60000),
+            "metadata" : {"temporary" : True}
+        }
+        res = self._con.post(path=parent + "/add",
+                             postdata={"f" : "json",
+                                       "usagereport" : json.dumps(usagereport)})
+        if isinstance(res, dict) and 'error' in res:
+            raise Exception("Could not create the report: %s" % res)
+        url = parent + "/%s" % six.moves.urllib.parse.quote_plus(name)
+        try:
+            return self._con.post(path=url + "/data",
+                                  postdata={"f" : "json",
+                                            "filter" : queryFilter})
+        finally:
+            self._con.post(path=url + "/delete",
+                           postdata={"f" : "json"})
+    #----------------------------------------------------------------------
+    def to_frame(self, queryFilter=None):
+        """
+        Returns the report data as a time series. The time slices that are
+        closed (ended at least one aggregation interval ago) are kept in
+        memory, and in the SQLiteCache set on the cache property, so a
+        later call only requests the slices that are still open.
+
+        The cache is keyed on the report as saved on the server, so
+        values set on the properties but not saved with edit are not
+        used. The open slices are read from the report's data when they
+        fall inside its time range. Otherwise a temporary CUSTOM usage
+        report covering them is added to the server, queried and
+        deleted: three administrative requests that change the server's
+        configuration for the length of the query.
+
+        Inputs:
+           queryFilter - optional machine filter, see query. The default
+             is all machines.
+        Output:
+           a pandas DataFrame indexed by the end time of each slice, with
+           a (metric, resourceURI) column per series. When pandas is not
+           installed, a dictionary {"time" : array, "metrics" : {metric :
+           {resourceURI : array}}} of numpy arrays.
+        """
+        if not hasNumPy:
+            raise ImportError("numpy is required to build the report frame")
+        if queryFilter is None:
+            queryFilter = {"machines" : "*"}
+        definition = self._definition()
+        since = definition['since']
+        key = make_key(self._url, definition['queries'], since,
+                       definition['from'], definition['to'],
+                       definition['aggregationInterval'], queryFilter)
+        now = int(time.time() * 1000)
+        cached = self._slices.get(key, None)
+        if cached is None and self._cache is not None:
+            cached = self._cache.get(key)
+        if cached is None:
+            slices, series = _parse_report(self.query(queryFilter))
+            if len(slices) > 1:
+                interval = slices[1] - slices[0]
+            else:
+                interval = (definition['aggregationInterval'] or 30) * 60000
+            span = _SINCE_SPANS.get(since, len(slices) * interval)
+        else:
+            interval = cached['interval']
+            span = cached['span']
+            slices = list(cached['slices'])
+            series = dict(((m, u), list(v)) for m, u, v in cached['series'])
+            end = now
+            if since == "CUSTOM" and definition['to']:
+                end = min(now, definition['to'])
+            start = slices[-1] if slices else end - span
+            if end > start:
+                new_slices, new_series = _parse_report(
+                    self._query_range(start, end, interval, queryFilter))
+                keep = [i for i, t in enumerate(new_slices) if t > start]
+                for k in set(series) | set(new_series):
+                    old = series.get(k, [None] * len(slices))
+                    new = new_series.get(k, [None] * len(new_slices))
+                    series[k] = old + [new[i] for i in keep]
+                slices = slices + [new_slices[i] for i in keep]
+            if since != "CUSTOM":
+                # rolling reports drop the slices that left the window
+                first = 0
+                while first < len(slices) and slices[first] <= now - span:
+                    first += 1
+                slices = slices[first:]
+                series = dict((k, v[first:]) for k, v in series.items())
+        closed = len([t for t in slices if t <= now - interval])
+        record = {"interval" : interval,
+                  "span" : span,
+                  "slices" : slices[:closed],
+                  "series" : [[k[0], k[1], v[:closed]]
+                              for k, v in series.items()]}
+        self._slices[key] = record
+        if self._cache is not None:
+            self._cache.set(key, record)
+        return _build_frame(slices, series)
@@ -5,7 +5,9 @@
 """
 from __future__ import absolute_import
 import json
+import time
 from ...common._base import BaseServer
+from ...common._parallel import run_all
 from . import _machines, _clusters
 from . import _data, _info
 from . import _kml, _logs
@@ -37,6 +39,13 @@ class AGSAdministration(BaseServer):
     _resources = None
     _fullVersion = None
     #----------------------------------------------------------------------
+    def __init__(self, url, connection=None, initialize=True, **kwargs):
+        """Constructor"""
+        if url.lower().endswith('/admin') == False:
+            url = "%s/admin" % url
+        super(AGSAdministration, self).__init__(url, connection,
+                                                initialize, **kwargs)
+    #----------------------------------------------------------------------
     def init(self, connection=None):
         """ populates server admin information """
         if self._url.lower().endswith('/admin') == False:
@@ -417,3 +426,85 @@ class AGSAdministration(BaseServer):
                                     initialize=True)
         else:
             return None
+    #----------------------------------------------------------------------
+    def health_sweep(self, timeout=10, max_workers=16):
+        """
+        Checks the health of the whole site at once. The site health
+        check, the status of every machine, the state of every cluster
+        and the validation of every data store machine are requested
+        concurrently, after the machine, cluster and data store lists are
+        read concurrently.
+
+        Inputs:
+           timeout - the number of seconds each request may take, counted
+             from when it starts. A request still running is reported as
+             failed.
+           max_workers - the number of requests kept in flight
+        Output:
+           dictionary with the keys: healthy (True when every check
+           passed), elapsed (seconds) and checks, a dictionary of check
+           name (site, machine:<name>, cluster:<name> or
+           datastore:<item>/<machine>) to a dictionary with the keys: ok,
+           state, elapsed (seconds) and error
+        """
+        start = time.time()
+        url = self._url
+        params = {
+            "f" : "json"
+        }
+        def _get(path, query=None):
+            return lambda: self._con.get(path=path, params=query or params)
+        def _post(path):
+            return lambda: self._con.post(path=path, postdata=params)
+        lists = run_all({
+            "machines" : _get(url + "/machines"),
+            "clusters" : _get(url + "/clusters"),
+            "datastores" : _get(url + "/data/findItems",
+                                {"f" : "json",
+                                 "parentPath" : "/enterpriseDatabases"})
+        }, max_workers=max_workers, timeout=timeout)
+        def _listed(name, key):
+            result = lists[name]['result']
+            if isinstance(result, dict):
+                return result.get(key, [])
+            return []
+        calls = {"site" : _get(url + "/info/healthCheck")}
+        checks = {"site" : lambda res: res.get('success', False) == True}
+        for machine in _listed("machines", "machines"):
+            name = "machine:%s" % machine['machineName']
+            calls[name] = _get(url + "/machines/%s/status" % machine['machineName'])
+            checks[name] = lambda res: res.get('realTimeState', None) == "STARTED"
+        for cluster in _listed("clusters", "clusters"):
+            name = "cluster:%s" % cluster['clusterName']
+            calls[name] = _get(url + "/clusters/%s" % cluster['clusterName'])
+            checks[name] = lambda res: res.get('configuredState', None) == "STARTED"
+        for item in _listed("datastores", "items"):
+            item_path = item.get('path', '')
+            for machine in item.get('info', {}).get('machines', []):
+                name = "datastore:%s/%s" % (item_path.rsplit('/', 1)[-1],
+                                            machine['name'])
+                calls[name] = _post(url + "/data/items%s/machines/%s/validate" % \
+                                    (item_path, machine['name']))
+                checks[name] = lambda res: res.get('status', None) == "success"
+        results = run_all(calls, max_workers=max_workers, timeout=timeout)
+        report = {}
+        for name in ("machines", "clusters", "datastores"):
+            if lists[name]['error'] is not None:
+                report["list:%s" % name] = {"ok" : False,
+                                            "state" : None,
+                                            "elapsed" : lists[name]['elapsed'],
+                                            "error" : str(lists[name]['error'])}
+        for name, res in results.items():
+            result = res['result']
+            ok = isinstance(result, dict) and 'error' not in result and \
+                checks[name](result)
+            error = res['error']
+            if error is None and not ok:
+                error = result
+            report[name] = {"ok" : ok,
+                            "state" : result,
+                            "elapsed" : res['elapsed'],
+                            "error" : None if error is None else str(error)}
+        return {"healthy" : all(c['ok'] for c in report.values()),
+                "elapsed" : time.time() - start,
+                "checks" : report}
@@ -1,6 +1,51 @@
 from __future__ import absolute_import
+import re
+import json
+import math
+import time
+import threading
+import itertools
+import six
 from ..common._geom import Point
 from ..common._base import BaseService
+from ..common._cache import make_key, LRUCache
+from ..common._parallel import imap
+
+_ABBREVIATIONS = {
+    "STREET" : "ST", "AVENUE" : "AVE", "ROAD" : "RD", "DRIVE" : "DR",
+    "BOULEVARD" : "BLVD", "LANE" : "LN", "COURT" : "CT", "PLACE" : "PL",
+    "HIGHWAY" : "HWY", "PARKWAY" : "PKWY", "SUITE" : "STE",
+    "APARTMENT" : "APT", "NORTH" : "N", "SOUTH" : "S", "EAST" : "E",
+    "WEST" : "W", "NORTHEAST" : "NE", "NORTHWEST" : "NW",
+    "SOUTHEAST" : "SE", "SOUTHWEST" : "SW"
+}
+#----------------------------------------------------------------------
+def _normalize_address(address):
+    """
+    returns a canonical form of a single line address, or of a
+    dictionary of address fields, used as a cache key. Case, punctuation,
+    extra white space and common street word spellings are ignored.
+    """
+    if isinstance(address, dict):
+        return sorted([(k.upper(), _normalize_address(v))
+                       for k, v in address.items()
+                       if k.upper() != "OBJECTID"])
+    if address is None:
+        return ""
+    if not isinstance(address, six.string_types):
+        address = str(address)
+    words = re.sub(r"[^\w#]+", " ", address.upper()).split()
+    return " ".join([_ABBREVIATIONS.get(w, w) for w in words])
+#----------------------------------------------------------------------
+def _location_xy(location):
+    """returns (x, y, wkid) of a Point, x/y dictionary or [x, y] list"""
+    if isinstance(location, dict):
+        sr = location.get('spatialReference', None) or {}
+        return (float(location['x']), float(location['y']),
+                sr.get('latestWkid', sr.get('wkid', None)))
+    if isinstance(location, (list, tuple)):
+        return float(location[0]), float(location[1]), None
+    return None
 ########################################################################
 class GeocodeService(BaseService):
     """
@@ -29,6 +74,8 @@ class GeocodeService(BaseService):
     _serviceDescription = None
     _countries = None
     _categories = None
+    _cache = None
+    _cache_precision = 5
     #----------------------------------------------------------------------
     @property
     def countries(self):
@@ -107,6 +154,33 @@ class GeocodeService(BaseService):
             self.init()
         return self._serviceDescription
     #----------------------------------------------------------------------
+    @property
+    def cache(self):
+        """
+        gets/sets a SQLiteCache used to answer repeated
+        findAddressCandidates, geocodeAddresses and reverseGeocode
+        requests without calling the server
+        """
+        return self._cache
+    #----------------------------------------------------------------------
+    @cache.setter
+    def cache(self, value):
+        """gets/sets the result cache"""
+        self._cache = value
+    #----------------------------------------------------------------------
+    @property
+    def cache_precision(self):
+        """
+        gets/sets the number of decimals reverse geocode locations are
+        rounded to before they are looked up in the cache
+        """
+        return self._cache_precision
+    #----------------------------------------------------------------------
+    @cache_precision.setter
+    def cache_precision(self, value):
+        """gets/sets the reverse geocode cache precision"""
+        self._cache_precision = value
+    #----------------------------------------------------------------------
     def find(self,
              text,
              magicKey=None,
@@ -360,8 +434,23 @@ class GeocodeService(BaseService):
             params['location'] = location.as_dict
         elif isinstance(location, list):
             params['location'] = "%s,%s" % (location[0], location[1])
-        return self._con.post(path=url,
-                             postdata=params)
+        if self._cache is None:
+            return self._con.post(path=url,
+                                 postdata=params)
+        key_params = dict(params)
+        if not singleLine is None:
+            key_params['singleLine'] = _normalize_address(singleLine)
+        if not addressDict is None:
+            for k in addressDict.keys():
+                key_params[k] = _normalize_address(addressDict[k])
+        key = make_key("findAddressCandidates", self._url, key_params)
+        res = self._cache.get(key)
+        if res is None:
+            res = self._con.post(path=url,
+                                 postdata=params)
+            if isinstance(res, dict) and not 'error' in res:
+                self._cache.set(key, res)
+        return res
     #----------------------------------------------------------------------
     def geocodeAddresses(self,
                          addresses,
@@ -428,8 +517,162 @@ class GeocodeService(BaseService):
         params['sourceCountry'] = sourceCountry
         params['category'] = category
         params['addresses'] = addresses
-        return self._con.post(path=url,
+        if self._cache is None or \
+           not isinstance(addresses, dict) or \
+           not 'records' in addresses:
+            return self._con.post(path=url,
+                                 postdata=params)
+        return self._cached_geocode(url, params)
+    #----------------------------------------------------------------------
+    def _cached_geocode(self, url, params):
+        """
+        answers the records of a geocodeAddresses request from the cache
+        and only sends the records that are not cached to the server
+        """
+        hits = []
+        misses = []
+        keys = {}
+        sr = None
+        for record in params['addresses']['records']:
+            attributes = record.get('attributes', {})
+            oid = None
+            for k, v in attributes.items():
+                if k.upper() == "OBJECTID":
+                    oid = v
+            if oid is None:
+                misses.append(record)
+                continue
+            key = make_key("geocodeAddresses", self._url,
+                           _normalize_address(attributes),
+                           params['outSR'], params['sourceCountry'],
+                           params['category'])
+            value = self._cache.get(key)
+            if value is None:
+                keys[str(oid)] = key
+                misses.append(record)
+            else:
+                loc = value['location']
+                loc.setdefault('attributes', {})['ResultID'] = oid
+                hits.append(loc)
+                sr = value.get('spatialReference', None)
+        if len(misses) == 0:
+            return {"spatialReference" : sr,
+                    "locations" : hits}
+        params = dict(params)
+        params['addresses'] = {"records" : misses}
+        res = self._con.post(path=url,
                              postdata=params)
+        if not isinstance(res, dict) or 'error' in res:
+            return res
+        sr = res.get('spatialReference', sr)
+        items = []
+        for loc in res.get('locations', []):
+            rid = loc.get('attributes', {}).get('ResultID', None)
+            if str(rid) in keys:
+                items.append((keys[str(rid)],
+                              {"location" : loc,
+                               "spatialReference" : sr}))
+        if len(items) > 0:
+            self._cache.set_many(items)
+        res['locations'] = hits + res.get('locations', [])
+        return res
+    #----------------------------------------------------------------------
+    def _batch_size(self, batch_size=None):
+        """
+        returns the number of addresses to send per geocodeAddresses
+        request based on the locator's SuggestedBatchSize and MaxBatchSize
+        """
+        props = self.locatorProperties or {}
+        max_size = props.get('MaxBatchSize', None)
+        if batch_size is None:
+            batch_size = props.get('SuggestedBatchSize', None) or \
+                max_size or 150
+        if max_size:
+            batch_size = min(batch_size, max_size)
+        return max(1, int(batch_size))
+    #----------------------------------------------------------------------
+    def batch_geocode(self,
+                      addresses,
+                      outSR=4326,
+                      sourceCountry=None,
+                      category=None,
+                      batch_size=None,
+                      max_workers=4,
+                      max_retries=3,
+                      retry_wait=1):
+        """
+        Geocodes any number of addresses by splitting them into batches
+        the size the locator suggests and sending the batches to
+        geocodeAddresses concurrently. The addresses are read lazily, so a
+        generator over a large file can be passed in.
+
+        Inputs:
+           addresses - an iterable of single line address strings or of
+            dictionaries of the locator's address fields
+           outSR - the spatial reference of the returned locations
+           sourceCountry - optional country to limit the search to
+           category - optional category to limit the search to
+           batch_size - the number of addresses per request. The default
+            is the locator's SuggestedBatchSize. The value is never larger
+            than MaxBatchSize.
+           max_workers - the number of batches to send at the same time
+           max_retries - the number of times a failed batch is sent again
+           retry_wait - seconds to wait before the first retry, doubled
+            on each following retry
+        Output:
+           generator returning one location dictionary per address, in
+           the same order as the input, or None when the address was not
+           returned by the server
+        """
+        batch_size = self._batch_size(batch_size)
+        field = "SingleLine"
+        if isinstance(self.singleLineAddressField, dict):
+            field = self.singleLineAddressField.get('name', field)
+        def _batches():
+            index = 0
+            items = iter(addresses)
+            while True:
+                chunk = list(itertools.islice(items, batch_size))
+                if len(chunk) == 0:
+                    return
+                yield index, chunk
+                index += len(chunk)
+        def _geocode(batch):
+            start, chunk = batch
+            records = []
+            for offset, address in enumerate(chunk):
+                if isinstance(address, six.string_types):
+                    attributes = {field : address}
+                else:
+                    attributes = dict(address)
+                attributes['OBJECTID'] = start + offset
+                records.append({"attributes" : attributes})
+            attempt = 0
+            while True:
+                try:
+                    res = self.geocodeAddresses(addresses={"records" : records},
+                                                outSR=outSR,
+                                                sourceCountry=sourceCountry,
+                                                category=category)
+                    if isinstance(res, dict) and 'error' in res:
+                        raise Exception(res['error'])
+                    break
+                except Exception:
+                    if attempt >= max_retries:
+                        raise
+                    time.sleep(retry_wait * (2 ** attempt))
+                    attempt += 1
+            found = {}
+            for loc in res.get('locations', []):
+                rid = loc.get('attributes', {}).get('ResultID', None)
+                if rid is not None:
+                    found[int(rid)] = loc
+            return [found.get(start + offset, None)
+                    for offset in range(len(chunk))]
+        for _, locations in imap(_geocode, _batches(),
+                                 max_workers=max_workers):
+            for loc in locations:
+                yield loc
     #----------------------------------------------------------------------
     def reverseGeocode(self, location):
         """
@@ -439,29 +682,114 @@ class GeocodeService(BaseService):
         closest to the location.
 
         Input:
-           location - either an Point object or a list defined as [X,Y]
+           location - a Point, an x/y dictionary or a list defined as
+            [X,Y]. The spatial reference of a Point or dictionary is sent
+            with it.
 
         """
         params = {
             "f" : "json"
         }
         url = self._url + "/reverseGeocode"
-        if isinstance(location, Point):
-            params['location'] = location.as_dict
-        elif isinstance(location, dict):
-            params['location'] = "%s,%s" % (location['x'], location['y'])
+        if isinstance(location, dict):
+            if location.get('spatialReference', None):
+                params['location'] = json.dumps(
+                    {"x" : location['x'],
+                     "y" : location['y'],
+                     "spatialReference" : location['spatialReference']})
+            else:
+                params['location'] = "%s,%s" % (location['x'], location['y'])
         elif isinstance(location, list):
             params['location'] = "%s,%s" % (location[0], location[1])
         else:
             raise Exception("Invalid location")
-        return self._con.post(path=url,
-                             postdata=params)
+        if self._cache is None:
+            return self._con.post(path=url,
+                                 postdata=params)
+        x, y, wkid = _location_xy(location)
+        key = make_key("reverseGeocode", self._url,
+                       round(x, self._cache_precision),
+                       round(y, self._cache_precision), wkid)
+        res = self._cache.get(key)
+        if res is None:
+            res = self._con.post(path=url,
+                                 postdata=params)
+            if isinstance(res, dict) and not 'error' in res:
+                self._cache.set(key, res)
+        return res
+    #----------------------------------------------------------------------
+    def batch_reverse_geocode(self,
+                              locations,
+                              grid_size=0.0001,
+                              max_workers=8,
+                              chunk_size=10000,
+                              max_cells=100000):
+        """
+        Reverse geocodes any number of points. The points are snapped to
+        a grid of grid_size cells and only the center of every distinct
+        cell is sent to reverseGeocode, so points that are close to each
+        other share one request. Each result is then returned for every
+        point that fell in its cell.
+
+        The points are read lazily in chunks of chunk_size. The results of
+        the max_cells most recently used cells are kept, so cells resolved
+        in an earlier chunk are usually not requested again.
+
+        Inputs:
+           locations - an iterable of Point objects, x/y dictionaries or
+            [x, y] lists
+           grid_size - the cell size in the units of the points, ex:
+            0.0001 degrees is about 11 meters
+           max_workers - the number of cells to resolve at the same time
+           chunk_size - the number of points read before their cells are
+            resolved
+           max_cells - the number of resolved cells kept between chunks
+        Output:
+           generator returning the reverseGeocode result of each point in
+           input order
+        """
+        resolved = LRUCache(max_items=max_cells)
+        items = iter(locations)
+        def _resolve(cell):
+            col, row, wkid = cell
+            center = {"x" : round((col + 0.5) * grid_size, 10),
+                      "y" : round((row + 0.5) * grid_size, 10)}
+            if wkid is not None:
+                center['spatialReference'] = {"wkid" : wkid}
+            return self.reverseGeocode(location=center)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if len(chunk) == 0:
+                return
+            cells = []
+            for location in chunk:
+                xy = _location_xy(location)
+                if xy is None:
+                    raise Exception("Invalid location: %s" % location)
+                cells.append((int(math.floor(xy[0] / grid_size)),
+                              int(math.floor(xy[1] / grid_size)),
+                              xy[2]))
+            results = {}
+            unique = []
+            for cell in set(cells):
+                if cell in resolved:
+                    results[cell] = resolved.get(cell)
+                else:
+                    unique.append(cell)
+            for index, result in imap(_resolve, unique,
+                                      max_workers=max_workers,
+                                      ordered=False):
+                results[unique[index]] = result
+                resolved.set(unique[index], result)
+            for cell in cells:
+                yield results[cell]
     #----------------------------------------------------------------------
     def suggest(self,
                 text,
-                location,
+                location=None,
                 distance=2000,
-                category=None
+                category=None,
+                maxSuggestions=None
                 ):
         """
         The suggest operation is performed on a geocode service resource.
@@ -518,6 +846,7 @@ class GeocodeService(BaseService):
             resulting candidates based on their distance from a location.
            category - The category parameter is only supported by geocode
             services published using StreetMap Premium locators.
+           maxSuggestions - the maximum number of suggestions returned
         """
         params = {
             "f" : "json",
@@ -530,12 +859,203 @@ class GeocodeService(BaseService):
             params['location'] = location
         elif isinstance(location, list):
             params['location'] = "%s,%s" % (location[0], location[1])
-        else:
+        elif not location is None:
             raise Exception("Invalid location, please try again")
         if not category is None:
             params['category'] = category
-        if not distance is None and \
+        if not maxSuggestions is None:
+            params['maxSuggestions'] = maxSuggestions
+        if not location is None and \
+           not distance is None and \
            isinstance(distance, (int, float)):
             params['distance'] = distance
         return self._con.post(path=url,
                               postdata=params)
+    #----------------------------------------------------------------------
+    def suggest_client(self, **kwargs):
+        """
+        returns a SuggestClient for type-ahead searches against this
+        service. The keywords are passed to the SuggestClient.
+        """
+        return SuggestClient(service=self, **kwargs)
+########################################################################
+class SuggestClient(object):
+    """
+    A suggest helper for search boxes that sends as few requests as it
+    can while the user types.
+
+    The suggestions of every prefix are kept in a prefix trie. When a
+    shorter prefix returned fewer than maxSuggestions results, that list
+    was complete, so any longer prefix is answered by filtering it
+    without calling the server. Requests made through request() can be
+    debounced, and the results of a request superseded by a newer prefix
+    are discarded instead of being delivered.
+
+    Inputs:
+       service - the GeocodeService
+       location - optional location passed to suggest
+       distance - optional distance passed to suggest
+       category - optional category passed to suggest
+       maxSuggestions - the number of suggestions requested, default 5
+       debounce - seconds request() waits for more typing before calling
+        the server
+       max_entries - the number of prefixes kept before the trie is reset
+    """
+    _service = None
+    _root = None
+    _lock = None
+    _timer = None
+    _generation = None
+    _entries = None
+    location = None
+    distance = None
+    category = None
+    maxSuggestions = None
+    debounce = None
+    max_entries = None
+    requests = None
+    local_hits = None
+    #----------------------------------------------------------------------
+    def __init__(self, service, location=None, distance=2000,
+                 category=None, maxSuggestions=5, debounce=0.15,
+                 max_entries=10000):
+        """Constructor"""
+        self._service = service
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.location = location
+        self.distance = distance
+        self.category = category
+        self.maxSuggestions = maxSuggestions
+        self.debounce = debounce
+        self.max_entries = max_entries
+        self.clear()
+    #----------------------------------------------------------------------
+    def clear(self):
+        """empties the prefix trie"""
+        with self._lock:
+            self._root = {"children" : {}, "suggestions" : None}
+            self._entries = 0
+            self.requests = 0
+            self.local_hits = 0
+    #----------------------------------------------------------------------
+    @staticmethod
+    def _normalize(text):
+        return " ".join(text.lower().split())
+    #----------------------------------------------------------------------
+    @staticmethod
+    def _matches(prefix, text):
+        """True when prefix starts at the start of a word of text"""
+        text = " ".join(text.lower().split())
+        start = text.find(prefix)
+        while start != -1:
+            if start == 0 or not text[start - 1].isalnum():
+                return True
+            start = text.find(prefix, start + 1)
+        return False
+    #----------------------------------------------------------------------
+    def _lookup(self, prefix):
+        """
+        returns the suggestions for a prefix from the trie, or None when
+        the server has to be asked
+        """
+        node = self._root
+        complete = None
+        for char in prefix:
+            node = node['children'].get(char, None)
+            if node is None:
+                break
+            if node['suggestions'] is not None and \
+               len(node['suggestions']) < self.maxSuggestions:
+                complete = node['suggestions']
+        else:
+            if node['suggestions'] is not None:
+                return node['suggestions']
+        if complete is None:
+            return None
+        return [s for s in complete
+                if self._matches(prefix, s.get('text', ''))]
+    #----------------------------------------------------------------------
+    def _store(self, prefix, suggestions):
+        if self._entries >= self.max_entries:
+            self._root = {"children" : {}, "suggestions" : None}
+            self._entries = 0
+        node = self._root
+        for char in prefix:
+            node = node['children'].setdefault(
+                char, {"children" : {}, "suggestions" : None})
+        if node['suggestions'] is None:
+            self._entries += 1
+        node['suggestions'] = suggestions
+    #----------------------------------------------------------------------
+    def suggest(self, text):
+        """
+        returns the list of suggestion dictionaries for the text, from the
+        trie when possible, else from the server
+        """
+        prefix = self._normalize(text)
+        if prefix == "":
+            return []
+        with self._lock:
+            found = self._lookup(prefix)
+            if found is not None:
+                self.local_hits += 1
+                return found
+            self.requests += 1
+        res = self._service.suggest(text=prefix,
+                                    location=self.location,
+                                    distance=self.distance,
+                                    category=self.category,
+                                    maxSuggestions=self.maxSuggestions)
+        if isinstance(res, dict) and 'error' in res:
+            raise Exception(res['error'])
+        suggestions = res.get('suggestions', [])
+        with self._lock:
+            self._store(prefix, suggestions)
+        return suggestions
+    #----------------------------------------------------------------------
+    def request(self, text, callback):
+        """
+        Asks for the suggestions of the text in the background, after the
+        debounce window. The callback is called with (text, suggestions)
+        only if no newer request was made in the meantime, so a slow
+        response for an old prefix never replaces a newer one.
+
+        Inputs:
+           text - the text typed so far
+           callback - function called with the text and its suggestions
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            if self._timer is not None:
+                self._timer.cancel()
+            found = self._lookup(self._normalize(text))
+            if found is not None:
+                self.local_hits += 1
+        if found is not None:
+            callback(text, found)
+            return
+        def _run():
+            if generation != self._generation:
+                return
+            suggestions = self.suggest(text)
+            if generation == self._generation:
+                callback(text, suggestions)
+        self._timer = threading.Timer(self.debounce or 0, _run)
+        self._timer.daemon = True
+        self._timer.start()
+    #----------------------------------------------------------------------
+    def cancel(self):
+        """discards the pending and in-flight background requests"""
+        with self._lock:
+            self._generation += 1
+            if self._timer is not None:
+                self._timer.cancel()
+    #----------------------------------------------------------------------
+    @property
+    def stats(self):
+        """returns the number of server requests and local answers"""
+        return {"requests" : self.requests,
+                "localHits" : self.local_hits,
+                "prefixes" : self._entries}
@@ -8,8 +8,17 @@
 """
 from __future__ import absolute_import
 from ..common._base import BaseService
-from ..common._utils import local_time_to_online
+from ..common._utils import local_time_to_online, create_uid
+from ..common._parallel import imap
+from ..common._raster import parse_bbox, parse_size, pixel_dtype
+from ..common._raster import split_extent, fetch_image, decode_raster
+from ..common._raster import create_array, hasNumPy
+import os
+import shutil
+import tempfile
 import datetime
+if hasNumPy:
+    import numpy as np
 ########################################################################
 class ImageService(BaseService):
     """
@@ -525,6 +534,251 @@ class ImageService(BaseService):
                              out_folder=saveFolder,
                              file_name=saveFile)
     #----------------------------------------------------------------------
+    def _block_params(self, bandIds=None, pixelType=None,
+                      raster_format="tiff", bboxSR=None, imageSR=None,
+                      renderingRule=None, mosaicRule=None,
+                      interpolation=None, noData=None, time=None):
+        """builds the exportImage parameters shared by every pixel block"""
+        params = {
+            "f" : "image",
+            "format" : raster_format
+        }
+        if pixelType is not None:
+            params['pixelType'] = pixelType
+        if bandIds is not None:
+            if isinstance(bandIds, (list, tuple)):
+                bandIds = ",".join([str(b) for b in bandIds])
+            params['bandIds'] = bandIds
+        if bboxSR is not None:
+            params['bboxSR'] = bboxSR
+        if imageSR is not None:
+            params['imageSR'] = imageSR
+        if renderingRule is not None:
+            params['renderingRule'] = renderingRule
+        if mosaicRule is not None:
+            params['mosaicRule'] = mosaicRule
+        if interpolation is not None:
+            params['interpolation'] = interpolation
+        if noData is not None:
+            params['noData'] = noData
+        if isinstance(time, datetime.datetime):
+            params['time'] = local_time_to_online(time)
+        elif time is not None:
+            params['time'] = time
+        return params
+    #----------------------------------------------------------------------
+    def _read_block(self, params, bbox, size, folder=None):
+        """requests a single pixel block and decodes it into an array"""
+        params = dict(params)
+        params['bbox'] = ",".join([repr(float(v)) for v in bbox])
+        params['size'] = "%s,%s" % (size[0], size[1])
+        path = fetch_image(con=self._con,
+                           url=self._url + "/exportImage",
+                           params=params,
+                           folder=folder)
+        return decode_raster(path, params['format'])
+    #----------------------------------------------------------------------
+    def _grid_blocks(self, bbox, size, block_size):
+        """
+        returns the blocks of a fixed grid, anchored at the origin of the
+        bbox's coordinate system, that cover a window. Each block has the
+        keys of a split_extent tile, where x and y are the offset in the
+        window, plus sx and sy (offset in the block), copyWidth and
+        copyHeight (pixels shared with the window) and resolution.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        width, height = size
+        resx = (xmax - xmin) / float(width)
+        resy = (ymax - ymin) / float(height)
+        px0 = int(round(xmin / resx))
+        py0 = int(round(-ymax / resy))
+        blocks = []
+        for row in range(py0 // block_size,
+                         (py0 + height - 1) // block_size + 1):
+            by = row * block_size
+            iy0 = max(py0, by)
+            iy1 = min(py0 + height, by + block_size)
+            for col in range(px0 // block_size,
+                             (px0 + width - 1) // block_size + 1):
+                bx = col * block_size
+                ix0 = max(px0, bx)
+                ix1 = min(px0 + width, bx + block_size)
+                blocks.append({
+                    "row" : row,
+                    "col" : col,
+                    "x" : ix0 - px0,
+                    "y" : iy0 - py0,
+                    "sx" : ix0 - bx,
+                    "sy" : iy0 - by,
+                    "copyWidth" : ix1 - ix0,
+                    "copyHeight" : iy1 - iy0,
+                    "width" : block_size,
+                    "height" : block_size,
+                    "resolution" : [resx, resy],
+                    "bbox" : [bx * resx,
+                              -(by + block_size) * resy,
+                              (bx + block_size) * resx,
+                              -by * resy]
+                })
+        return blocks
+    #----------------------------------------------------------------------
+    def read_window(self,
+                    bbox,
+                    size,
+                    bandIds=None,
+                    pixelType=None,
+                    raster_format="tiff",
+                    bboxSR=None,
+                    imageSR=None,
+                    renderingRule=None,
+                    mosaicRule=None,
+                    interpolation=None,
+                    noData=None,
+                    time=None,
+                    out_path=None,
+                    max_workers=4,
+                    memmap_threshold=512 * 1024 * 1024,
+                    cache=None,
+                    block_size=256):
+        """
+        Reads the pixel values of a window of the image service into a
+        numpy array of shape (height, width, bands).
+
+        The window is split into blocks no larger than maxImageWidth by
+        maxImageHeight. The blocks are requested concurrently as tiff or
+        lerc and decoded straight into the output array. Windows larger
+        than memmap_threshold bytes, or any window when out_path is given,
+        are written to a memory mapped .npy file instead of memory.
+
+        When out_path is None and the window is larger than
+        memmap_threshold, the pixels live in a new <tempdir>/<uid>.npy
+        file, where <tempdir> is tempfile.gettempdir(). The caller owns
+        that file and removes it once the array is no longer used, ex:
+
+            path = arr.filename
+            del arr
+            os.remove(path)
+
+        The file is removed when the read fails.
+
+        When a BlockCache is given, the window is read as block_size
+        square blocks on a fixed grid anchored at the origin of the
+        bbox's coordinate system, so overlapping or repeated windows at
+        the same resolution reuse blocks already read. The window is
+        snapped to the nearest pixel of that grid.
+
+        Requires numpy, plus tifffile or Pillow for tiff blocks and the
+        lerc package for lerc blocks.
+
+        Inputs:
+           bbox - the extent of the window as "xmin,ymin,xmax,ymax", a list
+            or an envelope dictionary
+           size - [width, height] of the window in pixels
+           bandIds - optional list of 0 based band ids to read
+           pixelType - pixel type of the returned values, ex: F32. The
+            default is the service's pixelType.
+           raster_format - tiff (default) or lerc
+           bboxSR - spatial reference of the bbox
+           imageSR - spatial reference of the returned pixels
+           renderingRule - optional rendering rule dictionary
+           mosaicRule - optional mosaic rule dictionary
+           interpolation - optional resampling method
+           noData - optional noData value
+           time - optional time instant or extent
+           out_path - optional .npy file to memory map the result to
+           max_workers - the number of blocks to request at the same time
+           memmap_threshold - windows larger than this many bytes are
+            memory mapped to a temporary .npy file when out_path is None.
+            The path of that file is the filename of the returned array.
+           cache - optional BlockCache used to reuse pixel blocks between
+            reads
+           block_size - the width and height in pixels of a cached block
+        Output:
+           numpy array or numpy.memmap (its filename is the .npy file)
+        """
+        bbox = parse_bbox(bbox)
+        size = parse_size(size)
+        if pixelType is None:
+            pixelType = self.pixelType
+        dtype = pixel_dtype(pixelType)
+        if dtype is None:
+            pixelType = None
+        params = self._block_params(bandIds=bandIds, pixelType=pixelType,
+                                    raster_format=raster_format,
+                                    bboxSR=bboxSR, imageSR=imageSR,
+                                    renderingRule=renderingRule,
+                                    mosaicRule=mosaicRule,
+                                    interpolation=interpolation,
+                                    noData=noData, time=time)
+        if cache is not None:
+            block_size = min(block_size,
+                             self.maxImageWidth or block_size,
+                             self.maxImageHeight or block_size)
+            tiles = self._grid_blocks(bbox, size, block_size)
+        else:
+            tiles = split_extent(bbox, size,
+                                 self.maxImageWidth or 2048,
+                                 self.maxImageHeight or 2048)
+        folder = tempfile.mkdtemp()
+        def _read_tile(tile):
+            key = None
+            if cache is not None:
+                key = cache.block_key(self._url, tile['resolution'],
+                                      tile['row'], tile['col'], block_size,
+                                      bandIds=bandIds,
+                                      renderingRule=renderingRule,
+                                      mosaicRule=mosaicRule,
+                                      pixelType=pixelType,
+                                      bboxSR=bboxSR, imageSR=imageSR,
+                                      interpolation=interpolation,
+                                      noData=noData,
+                                      time=params.get('time', None))
+                arr = cache.get(key)
+                if arr is not None:
+                    return arr
+            arr = self._read_block(params, tile['bbox'],
+                                   [tile['width'], tile['height']],
+                                   folder=folder)
+            if key is not None:
+                cache.set(key, arr)
+            return arr
+        result = None
+        temp_path = None
+        try:
+            for index, arr in imap(_read_tile, tiles,
+                                   max_workers=max_workers,
+                                   ordered=False):
+                tile = tiles[index]
+                if result is None:
+                    shape = (size[1], size[0], arr.shape[2])
+                    out_dtype = dtype or arr.dtype
+                    nbytes = shape[0] * shape[1] * shape[2] * \
+                        np.dtype(out_dtype).itemsize
+                    if out_path is None and nbytes > memmap_threshold:
+                        out_path = temp_path = os.path.join(
+                            tempfile.gettempdir(), "%s.npy" % create_uid())
+                    result = create_array(shape, out_dtype, out_path)
+                sx = tile.get('sx', 0)
+                sy = tile.get('sy', 0)
+                h = min(tile.get('copyHeight', tile['height']),
+                        arr.shape[0] - sy)
+                w = min(tile.get('copyWidth', tile['width']),
+                        arr.shape[1] - sx)
+                result[tile['y']:tile['y'] + h,
+                       tile['x']:tile['x'] + w, :] = \
+                    arr[sy:sy + h, sx:sx + w, :result.shape[2]]
+        except:
+            if temp_path is not None:
+                result = None
+                if os.path.isfile(temp_path):
+                    os.remove(temp_path)
+            raise
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        if hasattr(result, 'flush'):
+            result.flush()
+        return result
+    #----------------------------------------------------------------------
     def query(self,
               where="1=1",
               out_fields="*",
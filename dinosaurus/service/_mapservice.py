@@ -9,8 +9,13 @@
 
 """
 import time
+import shutil
 import tempfile
 from ..common._base import BaseService
+from ..common._parallel import imap
+from ..common._raster import parse_bbox, parse_size, square_pixels
+from ..common._raster import split_extent, create_tiff, write_world_file
+from ..common._raster import fetch_image, decode_image
 from ..common import Polygon, SpatialReference
 from .geoprocessing import GPJob
 from ._featureservice import FeatureLayer, TableLayer, SchematicLayer
@@ -621,8 +626,27 @@ class MapService(BaseService):
          Output:
            Image of the map.
         """
+        params = self._export_params(bbox=bbox, bboxSR=bboxSR, size=size,
+                                     dpi=dpi, imageSR=imageSR,
+                                     image_format=image_format,
+                                     layerDefFilter=layerDefFilter,
+                                     layers=layers, transparent=transparent,
+                                     timeFilter=timeFilter,
+                                     layerTimeOptions=layerTimeOptions,
+                                     dynamicLayers=dynamicLayers,
+                                     mapScale=mapScale)
+        exportURL = self._url + "/export"
+        return self._con.get(path=exportURL,
+                             params=params)
+    #----------------------------------------------------------------------
+    def _export_params(self, bbox, bboxSR=None, size=None, dpi=None,
+                       imageSR=None, image_format=None, layerDefFilter=None,
+                       layers=None, transparent=None, timeFilter=None,
+                       layerTimeOptions=None, dynamicLayers=None,
+                       mapScale=None, f="json"):
+        """builds the parameters of an export operation"""
         params = {
-            "f" : "json"
+            "f" : f
         }
         params['bbox'] = bbox
         if bboxSR:
@@ -634,6 +658,8 @@ class MapService(BaseService):
         if imageSR is not None and \
            isinstance(imageSR, SpatialReference):
             params['imageSR'] = {'wkid': imageSR.wkid}
+        elif imageSR is not None:
+            params['imageSR'] = imageSR
         if image_format is not None:
             params['format'] = image_format
         if layerDefFilter is not None:
@@ -650,9 +676,101 @@ class MapService(BaseService):
             params['dynamicLayers'] = dynamicLayers
         if mapScale is not None:
             params['mapScale'] = mapScale
+        return params
+    #----------------------------------------------------------------------
+    def export_large_map(self,
+                         bbox,
+                         size,
+                         out_path,
+                         bboxSR=None,
+                         dpi=96,
+                         imageSR=None,
+                         image_format="png32",
+                         layerDefFilter=None,
+                         layers=None,
+                         transparent=False,
+                         timeFilter=None,
+                         layerTimeOptions=None,
+                         dynamicLayers=None,
+                         max_workers=4,
+                         tile_size=None):
+        """
+           Exports a map image larger than the service's maxImageWidth and
+           maxImageHeight. The requested extent is split into server sized
+           tiles which are exported concurrently and written, as they
+           arrive, into a memory mapped GeoTIFF-compatible raster on disk
+           with a world file next to it. Only the tiles being downloaded
+           are held in memory.
+
+           Requires numpy and Pillow.
+
+           Inputs:
+            bbox - (Required) The extent of the exported image as
+             "xmin,ymin,xmax,ymax", a list or an envelope dictionary. The
+             extent is widened, like the server does, so that pixels are
+             square. The world file assumes the bbox is in the spatial
+             reference of the output image.
+            size - (Required) The width and height of the whole image in
+             pixels, ex: [12000, 9000] or "12000,9000"
+            out_path - (Required) the .tif file to write. The world file
+             is written next to it (.tfw).
+            image_format - format requested for each tile. The default is
+             png32. jpg, jpeg and bmp tiles produce an RGB image, all
+             other formats produce RGBA.
+            max_workers - the number of tiles to export at the same time
+            tile_size - optional [width, height] of a tile. The default is
+             the service's maxImageWidth and maxImageHeight.
+            See exportMap for the remaining parameters.
+         Output:
+           dictionary with the keys: path, worldFile, bbox, size and tiles
+        """
+        bbox = square_pixels(parse_bbox(bbox), parse_size(size))
+        size = parse_size(size)
+        if tile_size is None:
+            tile_size = [self.maxImageWidth or 2048,
+                         self.maxImageHeight or 2048]
+        tile_size = parse_size(tile_size)
+        if image_format.lower() in ("jpg", "jpeg", "bmp"):
+            bands = 3
+        else:
+            bands = 4
+        tiles = split_extent(bbox, size, tile_size[0], tile_size[1])
         exportURL = self._url + "/export"
-        return self._con.get(path=exportURL,
-                             params=params)
+        folder = tempfile.mkdtemp()
+        def _export_tile(tile):
+            params = self._export_params(
+                bbox=",".join([str(v) for v in tile['bbox']]),
+                bboxSR=bboxSR,
+                size="%s,%s" % (tile['width'], tile['height']),
+                dpi=dpi, imageSR=imageSR, image_format=image_format,
+                layerDefFilter=layerDefFilter, layers=layers,
+                transparent=transparent, timeFilter=timeFilter,
+                layerTimeOptions=layerTimeOptions,
+                dynamicLayers=dynamicLayers, f="image")
+            path = fetch_image(con=self._con, url=exportURL,
+                               params=params, folder=folder)
+            return decode_image(path, bands=bands)
+        raster = create_tiff(out_path, size[0], size[1], bands)
+        try:
+            for index, arr in imap(_export_tile, tiles,
+                                   max_workers=max_workers,
+                                   ordered=False):
+                tile = tiles[index]
+                h = min(tile['height'], arr.shape[0])
+                w = min(tile['width'], arr.shape[1])
+                raster[tile['y']:tile['y'] + h,
+                       tile['x']:tile['x'] + w, :] = arr[:h, :w, :bands]
+                del arr
+            raster.flush()
+        finally:
+            del raster
+            shutil.rmtree(folder, ignore_errors=True)
+        wld = write_world_file(out_path, bbox, size)
+        return {"path" : out_path,
+                "worldFile" : wld,
+                "bbox" : bbox,
+                "size" : size,
+                "tiles" : len(tiles)}
 
     #----------------------------------------------------------------------
     def estimateExportTilesSize(self,
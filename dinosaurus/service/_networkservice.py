@@ -1,7 +1,93 @@
 """
 """
 from __future__ import absolute_import
+import json
+import math
+import time
+import threading
+import datetime
+import six
 from ..common._base import BaseService
+from arcgis._impl.connection import _ArcGISConnection
+from ..common._geom import Point
+from ..common._cache import make_key
+from ..common._parallel import imap
+try:
+    import numpy as np
+    hasNumPy = True
+except ImportError:
+    hasNumPy = False
+try:
+    from scipy import sparse as sp
+    hasSciPy = True
+except ImportError:
+    hasSciPy = False
+#----------------------------------------------------------------------
+def _point_features(points, prefix):
+    """
+    converts a list of Point objects, x/y dictionaries, [x, y] lists or
+    feature dictionaries into a feature set named prefix + index
+    """
+    features = []
+    for index, point in enumerate(points):
+        if isinstance(point, Point):
+            point = point.as_dict
+        if isinstance(point, dict) and 'geometry' in point:
+            feature = {"geometry" : point['geometry'],
+                       "attributes" : dict(point.get('attributes', {}))}
+        elif isinstance(point, dict):
+            feature = {"geometry" : point, "attributes" : {}}
+        else:
+            feature = {"geometry" : {"x" : point[0], "y" : point[1]},
+                       "attributes" : {}}
+        feature['attributes']['Name'] = "%s%s" % (prefix, index)
+        features.append(feature)
+    return {"features" : features}
+#----------------------------------------------------------------------
+def _snap(value, tolerance):
+    """rounds a coordinate to the nearest multiple of tolerance"""
+    return round(math.floor(float(value) / tolerance + 0.5) * tolerance, 10)
+#----------------------------------------------------------------------
+def _snap_locations(value, tolerance):
+    """
+    returns a copy of a network location parameter, given as the simple
+    "x,y;x,y" syntax, a feature set dictionary or a list, with every x/y
+    snapped to the tolerance. Used to build cache keys.
+    """
+    if isinstance(value, six.string_types):
+        snapped = []
+        for pair in value.split(';'):
+            parts = pair.split(',')
+            try:
+                snapped.append([_snap(v, tolerance) for v in parts])
+            except ValueError:
+                snapped.append(parts)
+        return snapped
+    if isinstance(value, Point):
+        value = value.as_dict
+    if isinstance(value, dict):
+        snapped = {}
+        for k, v in value.items():
+            if k in ('x', 'y') and isinstance(v, (int, float)):
+                snapped[k] = _snap(v, tolerance)
+            elif isinstance(v, (dict, list, Point)):
+                snapped[k] = _snap_locations(v, tolerance)
+            else:
+                snapped[k] = v
+        return snapped
+    if isinstance(value, list):
+        return [_snap_locations(v, tolerance) for v in value]
+    return value
+#----------------------------------------------------------------------
+def _time_bucket(value, bucket):
+    """returns the index of the bucket of seconds a time falls in"""
+    if isinstance(value, datetime.datetime):
+        return int(time.mktime(value.timetuple()) // bucket)
+    try:
+        # times are passed to the server as milliseconds since epoch
+        return int(float(value) / 1000.0 // bucket)
+    except (TypeError, ValueError):
+        return value
 
 ########################################################################
 class NetworkService(BaseService):
@@ -24,6 +110,18 @@ class NetworkService(BaseService):
     _serviceLimits = None
     _defaultTravelMode = None
     _trafficSupport = None
+    _layers = None
+    _travelModes = None
+    _lock = None
+    #----------------------------------------------------------------------
+    def __init__(self, item=None, gis=None, url=None,
+                 connection=None, initialize=True, **kwargs):
+        """Constructor"""
+        self._lock = threading.Lock()
+        super(NetworkService, self).__init__(item=item, gis=gis, url=url,
+                                             connection=connection,
+                                             initialize=initialize,
+                                             **kwargs)
     #----------------------------------------------------------------------
     @property
     def currentVersion(self):
@@ -38,59 +136,104 @@ class NetworkService(BaseService):
         return self._serviceDescription
     #----------------------------------------------------------------------
     def _load_layers(self, connection=None):
-        """loads the various layer types"""
-        self._closestFacilityLayers = []
-        self._routeLayers = []
-        self._serviceAreaLayers = []
-        params = {
-            "f" : "json",
-        }
+        """
+        builds the network layers of the service. The layers are not
+        loaded until one of their properties is read or prefetch is called.
+        """
         if connection is None:
             connection = self._con
-        json_dict = connection.get(path=self._url, params=params)
-        for k,v in json_dict.items():
-            if k == "routeLayers" and json_dict[k]:
-                self._routeLayers = []
-                for rl in v:
-                    self._routeLayers.append(
-                        RouteNetworkLayer(url=self._url + "/%s" % rl,
-                                          connection=connection,
-                                          initialize=True))
-            elif k == "serviceAreaLayers" and json_dict[k]:
-                self._serviceAreaLayers = []
-                for sal in v:
-                    self._serviceAreaLayers.append(
-                        ServiceAreaNetworkLayer(url=self._url + "/%s" % sal,
-                                                connection=connection,
-                                                initialize=False))
-            elif k == "closestFacilityLayers" and json_dict[k]:
-                self._closestFacilityLayers = []
-                for cf in v:
-                    self._closestFacilityLayers.append(
-                        ClosestFacilityNetworkLayer(url=self._url + "/%s" % cf,
-                                                connection=self._con,
-                                                initialize=False))
+        if self._json_dict is None:
+            self.init(connection)
+        layer_types = (
+            ("routeLayers", RouteNetworkLayer),
+            ("serviceAreaLayers", ServiceAreaNetworkLayer),
+            ("closestFacilityLayers", ClosestFacilityNetworkLayer)
+        )
+        layers = {}
+        for key, layer_type in layer_types:
+            layers[key] = []
+            for name in self._json_dict.get(key, None) or []:
+                layer = layer_type(url=self._url + "/%s" % name,
+                                   connection=connection,
+                                   initialize=False)
+                layer._service = self
+                layers[key].append(layer)
+        self._layers = layers
     #----------------------------------------------------------------------
     @property
     def routeLayers(self):
-        if self._routeLayers is None:
-            self.init()
-        self._load_layers()
-        return self._routeLayers
+        if self._layers is None:
+            self._load_layers()
+        return self._layers['routeLayers']
     #----------------------------------------------------------------------
     @property
     def serviceAreaLayers(self):
-        if self._serviceAreaLayers is None:
-            self.init()
-        self._load_layers()
-        return self._serviceAreaLayers
+        if self._layers is None:
+            self._load_layers()
+        return self._layers['serviceAreaLayers']
     #----------------------------------------------------------------------
     @property
     def closestFacilityLayers(self):
-        if self._closestFacilityLayers is None:
-            self.init()
-        self._load_layers()
-        return self._closestFacilityLayers
+        if self._layers is None:
+            self._load_layers()
+        return self._layers['closestFacilityLayers']
+    #----------------------------------------------------------------------
+    @property
+    def layers(self):
+        """returns every network layer of the service"""
+        return self.routeLayers + \
+               self.serviceAreaLayers + \
+               self.closestFacilityLayers
+    #----------------------------------------------------------------------
+    def prefetch(self, max_workers=4):
+        """
+        loads every network layer and the travel modes of the service
+        concurrently, instead of one at a time on first use
+
+        Inputs:
+           max_workers - the number of layers to load at the same time
+        Output:
+           list of the loaded network layers
+        """
+        layers = self.layers
+        pending = [layer for layer in layers if layer._json_dict is None]
+        for _ in imap(lambda layer: layer.init(), pending,
+                      max_workers=max_workers):
+            pass
+        self.retrieveTravelModes()
+        return layers
+    #----------------------------------------------------------------------
+    def retrieveTravelModes(self, refresh=False):
+        """
+        returns the travel modes defined on the network dataset. Every
+        layer of a service shares the same travel modes, so they are
+        requested once from the first layer and kept.
+
+        Inputs:
+           refresh - if True, the travel modes are requested again
+        """
+        if self._travelModes is not None and not refresh:
+            return self._travelModes
+        layers = self.layers
+        if len(layers) == 0:
+            return None
+        # threads asking at the same time wait for the first request
+        # instead of sending their own
+        with self._lock:
+            if self._travelModes is not None and not refresh:
+                return self._travelModes
+            res = self._con.get(path=layers[0].url + "/retrieveTravelModes",
+                                params={"f" : "json"})
+            if isinstance(res, dict) and 'error' in res:
+                return res
+            self._travelModes = res
+            return res
+    #----------------------------------------------------------------------
+    def refresh(self):
+        """reloads the service and rebuilds its network layers"""
+        self._layers = None
+        self._travelModes = None
+        self.init()
     #----------------------------------------------------------------------
     @property
     def serviceLimits(self):
@@ -151,6 +294,43 @@ class NetworkLayer(BaseService):
     _hasZ = None
     _supportedTravelModes = None
     _serviceLimits = None
+    _service = None
+    _cache = None
+    _cache_tolerance = 0.0001
+    _cache_time_bucket = 900
+    #----------------------------------------------------------------------
+    def __getattr__(self, name):
+        """
+        loads the layer the first time a value of its JSON that has no
+        property is read, so the layers a NetworkService builds with
+        initialize=False only call the server when they are used
+        """
+        if name.startswith('_') or \
+           self._json_dict is not None or \
+           self._con is None:
+            raise AttributeError(name)
+        self.init()
+        if name in self.__dict__:
+            return self.__dict__[name]
+        raise AttributeError(name)
+    #----------------------------------------------------------------------
+    @property
+    def connection(self):
+        """gets/sets the connection object"""
+        return self._con
+    #----------------------------------------------------------------------
+    @connection.setter
+    def connection(self, value):
+        """
+        gets/sets the connection object. A layer that is not loaded yet
+        keeps waiting for its first use instead of loading right away.
+        """
+        if value is not None and \
+           not isinstance(value, _ArcGISConnection):
+            raise ValueError("connection must be of type _ArcGISConnection")
+        self._con = value
+        if value is not None and self._json_dict is not None:
+            self.refresh()
     #----------------------------------------------------------------------
     @property
     def currentVersion(self):
@@ -286,6 +466,11 @@ class NetworkLayer(BaseService):
     #----------------------------------------------------------------------
     @property
     def supportedTravelModes(self):
+        if self._supportedTravelModes is None and \
+           self._service is not None:
+            modes = self._service.retrieveTravelModes()
+            if isinstance(modes, dict):
+                self._supportedTravelModes = modes.get('supportedTravelModes', None)
         if self._supportedTravelModes is None:
             self.init()
         return self._supportedTravelModes
@@ -299,10 +484,82 @@ class NetworkLayer(BaseService):
     def retrieveTravelModes(self):
         """identify all the valid travel modes that have been defined on the
         network dataset or in the portal if the GIS server is federated"""
+        if self._service is not None:
+            return self._service.retrieveTravelModes()
         url = self._url + "/retrieveTravelModes"
         params = {"f":"json"}
         return self._con.get(path=url,
                          params=params)
+    #----------------------------------------------------------------------
+    @property
+    def cache(self):
+        """
+        gets/sets a SQLiteCache used to reuse the results of solves with
+        the same snapped locations, travel mode, breaks and time of day
+        """
+        return self._cache
+    #----------------------------------------------------------------------
+    @cache.setter
+    def cache(self, value):
+        """gets/sets the solve cache"""
+        self._cache = value
+    #----------------------------------------------------------------------
+    @property
+    def cache_tolerance(self):
+        """
+        gets/sets the distance, in the units of the input locations, that
+        locations are snapped to before they are looked up in the cache
+        """
+        return self._cache_tolerance
+    #----------------------------------------------------------------------
+    @cache_tolerance.setter
+    def cache_tolerance(self, value):
+        """gets/sets the cache tolerance"""
+        self._cache_tolerance = value
+    #----------------------------------------------------------------------
+    @property
+    def cache_time_bucket(self):
+        """
+        gets/sets the number of seconds start times and times of day are
+        grouped by in the cache key
+        """
+        return self._cache_time_bucket
+    #----------------------------------------------------------------------
+    @cache_time_bucket.setter
+    def cache_time_bucket(self, value):
+        """gets/sets the cache time bucket"""
+        self._cache_time_bucket = value
+    #----------------------------------------------------------------------
+    def _solve_request(self, url, params, method="POST",
+                       location_keys=(), time_keys=()):
+        """
+        sends a solve request, answering it from the cache when one is set
+        """
+        key = None
+        if self._cache is not None:
+            key_params = dict(params)
+            for k in location_keys:
+                if k in key_params:
+                    key_params[k] = _snap_locations(key_params[k],
+                                                    self._cache_tolerance)
+            for k in time_keys:
+                if k in key_params:
+                    key_params[k] = _time_bucket(key_params[k],
+                                                 self._cache_time_bucket)
+            key = make_key(url, method.lower(), key_params)
+            res = self._cache.get(key)
+            if res is not None:
+                return res
+        if method.lower() == "post":
+            res = self._con.post(path=url,
+                                 postdata=params)
+        else:
+            res = self._con.get(path=url,
+                                params=params)
+        if key is not None and \
+           isinstance(res, dict) and not 'error' in res:
+            self._cache.set(key, res)
+        return res
 ########################################################################
 class RouteNetworkLayer(NetworkLayer):
     """
@@ -653,12 +910,49 @@ class RouteNetworkLayer(NetworkLayer):
         if not returnZ is None:
             params['returnZ'] = returnZ
 
-        if method.lower() == "post":
-            return self._con.post(path=url,
-                              postdata=params)
-        else:
-            return self._con.get(path=url,
-                                params=params)
+        return self._solve_request(url, params, method,
+                                   location_keys=('stops', 'barriers',
+                                                  'polylineBarriers',
+                                                  'polygonBarriers'),
+                                   time_keys=('startTime',))
+    #----------------------------------------------------------------------
+    def solve_batch(self, stop_sets, max_workers=4, **kwargs):
+        """
+        Solves many routes that share the same parameters. The stop sets
+        are solved concurrently, at most max_workers at a time, and the
+        results are returned as soon as each solve finishes.
+
+        Inputs:
+           stop_sets - an iterable of stops values, one per route, in any
+            form accepted by solve
+           max_workers - the number of solves to run at the same time
+           kwargs - any other solve parameter, ex: travelMode or barriers,
+            applied to every route
+        Output:
+           generator of dictionaries with the keys: index (position of the
+           stop set in the input), result, error (the exception raised by
+           a failed solve or None) and elapsed (seconds)
+        """
+        if not self.layerType == "esriNAServerRouteLayer":
+            raise ValueError("The solve operation is supported on a network "
+                             "layer of Route type only")
+        def _solve(stops):
+            start = time.time()
+            try:
+                return self.solve(stops=stops, **kwargs), None, \
+                       time.time() - start
+            except Exception as e:
+                return None, e, time.time() - start
+        for index, (result, error, elapsed) in imap(_solve, stop_sets,
+                                                    max_workers=max_workers,
+                                                    ordered=False):
+            if error is None and \
+               isinstance(result, dict) and 'error' in result:
+                error = Exception(result['error'])
+            yield {"index" : index,
+                   "result" : result,
+                   "error" : error,
+                   "elapsed" : elapsed}
 
 
 ########################################################################
@@ -1039,12 +1333,11 @@ class ServiceAreaNetworkLayer(NetworkLayer):
         if not returnZ is None:
             params['returnZ'] = returnZ
 
-        if method.lower() == "post":
-            return self._con.post(path=url,
-                              postdata=params)
-        else:
-            return self._con.get(path=url,
-                                params=params)
+        return self._solve_request(url, params, method,
+                                   location_keys=('facilities', 'barriers',
+                                                  'polylineBarriers',
+                                                  'polygonBarriers'),
+                                   time_keys=('timeOfDay',))
 
 
 ########################################################################
@@ -1402,3 +1695,147 @@ class ClosestFacilityNetworkLayer(NetworkLayer):
         else:
             return self._con.get(path=url,
                                 params=params)
+    #----------------------------------------------------------------------
+    def _od_block_sizes(self):
+        """
+        returns the largest number of incidents and facilities a single
+        solve accepts, from the layer's serviceLimits
+        """
+        limits = {}
+        for k, v in (self.serviceLimits or {}).items():
+            limits[k.lower()] = v
+        incidents = limits.get('maximumincidents', None) or 100
+        facilities = min(limits.get('maximumfacilities', None) or 100,
+                         limits.get('maximumfacilitiestofind', None) or 100)
+        return int(incidents), int(facilities)
+    #----------------------------------------------------------------------
+    def _travel_mode_impedance(self, travelMode):
+        """
+        returns the impedanceAttributeName of a travel mode given as a
+        dictionary, a JSON string, or the name or id of one of the
+        service's travel modes
+        """
+        mode = travelMode
+        if isinstance(mode, six.string_types):
+            try:
+                mode = json.loads(mode)
+            except ValueError:
+                pass
+        if isinstance(mode, dict):
+            return mode.get('impedanceAttributeName', None)
+        modes = self.retrieveTravelModes()
+        if isinstance(modes, dict):
+            modes = modes.get('supportedTravelModes', [])
+        for m in modes or []:
+            if str(travelMode) in (str(m.get('name', None)),
+                                   str(m.get('id', None)),
+                                   str(m.get('travelModeId', None))):
+                return m.get('impedanceAttributeName', None)
+        raise ValueError("Unknown travel mode: %s" % travelMode)
+    #----------------------------------------------------------------------
+    def od_matrix(self,
+                  origins,
+                  destinations,
+                  travelMode=None,
+                  defaultCutoff=None,
+                  impedanceAttributeName=None,
+                  sparse=False,
+                  max_workers=4,
+                  **kwargs):
+        """
+        Builds an origin-destination cost matrix with solveClosestFacility.
+        The origins (incidents) and destinations (facilities) are split
+        into blocks no larger than the layer's serviceLimits, every pair of
+        blocks is solved concurrently and the costs are assembled into a
+        single matrix.
+
+        Requires numpy, plus scipy when sparse is True.
+
+        Inputs:
+           origins - list of Point objects, x/y dictionaries, [x, y] lists
+            or feature dictionaries
+           destinations - list in the same forms as origins
+           travelMode - optional travel mode
+           defaultCutoff - optional cost past which pairs are not solved
+           impedanceAttributeName - optional impedance attribute. The
+            default is the impedance of the travel mode, or the layer's
+            impedance when no travel mode is given.
+           sparse - if True, scipy.sparse csr_matrix objects holding only
+            the solved pairs are returned. Useful with a defaultCutoff.
+           max_workers - the number of blocks to solve at the same time
+           kwargs - any other solveClosestFacility parameter
+        Output:
+           numpy array of shape (len(origins), len(destinations)) where
+           pairs that could not be solved are NaN, so they are not
+           mistaken for a zero cost (an origin on a destination). When
+           sparse is True, a tuple of two csr_matrix objects: the costs,
+           and a boolean matrix that is True for the solved pairs, since
+           an unsolved pair and a zero cost both read as 0 in the costs.
+        """
+        if not self.layerType == "esriNAServerClosestFacilityLayer":
+            raise ValueError("The solveClosestFacility operation is supported on a network "
+                             "layer of Closest Facility type only")
+        if not hasNumPy:
+            raise ImportError("numpy is required to build a cost matrix")
+        if sparse and not hasSciPy:
+            raise ImportError("scipy is required to build a sparse cost matrix")
+        origins = list(origins)
+        destinations = list(destinations)
+        max_inc, max_fac = self._od_block_sizes()
+        impedance = impedanceAttributeName
+        if impedance is None and travelMode is not None:
+            impedance = self._travel_mode_impedance(travelMode)
+        if impedance is None:
+            impedance = self.impedance
+        cost_field = "Total_%s" % impedance
+        blocks = [(i, j) for i in range(0, len(origins), max_inc)
+                  for j in range(0, len(destinations), max_fac)]
+        kwargs.setdefault('outputLines', "esriNAOutputLineNone")
+        kwargs['returnCFRoutes'] = True
+        def _solve(block):
+            i, j = block
+            incs = origins[i:i + max_inc]
+            facs = destinations[j:j + max_fac]
+            res = self.solveClosestFacility(
+                incidents=_point_features(incs, "o%s_" % i),
+                facilities=_point_features(facs, "d%s_" % j),
+                travelMode=travelMode,
+                defaultCutoff=defaultCutoff,
+                defaultTargetFacilityCount=len(facs),
+                impedanceAttributeName=impedanceAttributeName,
+                **kwargs)
+            if isinstance(res, dict) and 'error' in res:
+                raise Exception(res['error'])
+            rows, cols, costs = [], [], []
+            for route in res.get('routes', {}).get('features', []):
+                attr = route.get('attributes', {})
+                if cost_field not in attr:
+                    raise ValueError("The routes have no %s field" % cost_field)
+                cost = attr[cost_field]
+                if cost is None:
+                    continue
+                rows.append(i + int(attr['IncidentID']) - 1)
+                cols.append(j + int(attr['FacilityID']) - 1)
+                costs.append(cost)
+            return rows, cols, costs
+        rows, cols, costs = [], [], []
+        for _, (r, c, v) in imap(_solve, blocks,
+                                 max_workers=max_workers,
+                                 ordered=False):
+            rows.extend(r)
+            cols.extend(c)
+            costs.extend(v)
+        shape = (len(origins), len(destinations))
+        if sparse:
+            index = (np.asarray(rows, dtype="int64"),
+                     np.asarray(cols, dtype="int64"))
+            matrix = sp.csr_matrix((np.asarray(costs, dtype="float64"),
+                                    index), shape=shape)
+            solved = sp.csr_matrix((np.ones(len(costs), dtype=bool),
+                                    index), shape=shape)
+            return matrix, solved
+        matrix = np.full(shape, np.nan, dtype="float64")
+        if len(costs) > 0:
+            matrix[np.asarray(rows, dtype="int64"),
+                   np.asarray(cols, dtype="int64")] = costs
+        return matrix
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from ._geoprocessing import GPJob, GPService, GPTask
+from ._executor import map_jobs
 from ._gpobjects import GPBoolean, GPDataFile, GPDate
 from ._gpobjects import GPDouble, GPFeatureRecordSetLayer, GPLinearUnit
 from ._gpobjects import GPLong, GPMultiValue, GPRasterData
@@ -11,4 +12,5 @@ __all__ = ['GPJob', 'GPService', 'GPTask',
            'GPBoolean', 'GPDataFile', 'GPDate',
            'GPDouble', 'GPFeatureRecordSetLayer', 'GPLinearUnit',
            'GPLong', 'GPMultiValue', 'GPRasterData',
-           'GPRasterDataLayer', 'GPRecordSet', 'GPString']
+           'GPRasterDataLayer', 'GPRecordSet', 'GPString',
+           'map_jobs']
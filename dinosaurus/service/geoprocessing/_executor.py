@@ -0,0 +1,124 @@
+"""
+
+.. module:: _executor.py
+   :platform: Windows, Linux
+   :synopsis: Runs a geoprocessing task over many inputs with a bounded
+              number of jobs in flight.
+.. moduleauthor:: Esri
+
+"""
+from __future__ import absolute_import
+import time
+import itertools
+from ...common._parallel import imap
+
+FINISHED_STATUSES = ("esriJobSucceeded", "esriJobFailed",
+                     "esriJobCancelled", "esriJobTimedOut")
+#----------------------------------------------------------------------
+def _job_status(job):
+    """returns the current status of a job, or the error raised while
+    checking it"""
+    try:
+        return job.jobStatus
+    except Exception as e:
+        return e
+#----------------------------------------------------------------------
+def map_jobs(task,
+             inputs,
+             max_concurrent=4,
+             poll_interval=1,
+             max_poll_interval=30,
+             max_retries=2,
+             **kwargs):
+    """
+    Runs a GPTask once for every set of inputs, keeping max_concurrent
+    jobs submitted at any time.
+
+    The status of the running jobs is checked concurrently. The wait
+    between checks starts at poll_interval and doubles, up to
+    max_poll_interval, while no job finishes. Failed, cancelled and timed
+    out jobs are submitted again up to max_retries times.
+
+    Inputs:
+       task - the GPTask to run
+       inputs - an iterable of input lists, each one the inputs of a single
+        submit_job call. It is read lazily.
+       max_concurrent - the number of jobs to keep in flight
+       poll_interval - the shortest wait, in seconds, between status checks
+       max_poll_interval - the longest wait, in seconds, between checks
+       max_retries - the number of times a failed job is submitted again
+       kwargs - any other submit_job parameter, ex: outSR
+    Output:
+       generator of dictionaries, in the order the jobs finish, with the
+       keys: index (position of the inputs), inputs, job (the last GPJob
+       or None), status, attempts, error and elapsed (seconds since the
+       first submit). The results of a succeeded job are read from
+       job.results.
+    """
+    items = enumerate(inputs)
+    retries = []
+    running = []
+    wait = poll_interval
+    def _submit(entry):
+        index, values, attempts, start = entry
+        try:
+            job = task.submit_job(inputs=values, **kwargs)
+        except Exception as e:
+            return None, e
+        return job, None
+    def _report(entry, job, status, error):
+        index, values, attempts, start = entry
+        return {"index" : index,
+                "inputs" : values,
+                "job" : job,
+                "status" : status,
+                "attempts" : attempts,
+                "error" : error,
+                "elapsed" : time.time() - start}
+    while True:
+        finished = []
+        # fill the free slots, retries first
+        while len(running) < max_concurrent:
+            if retries:
+                entry = retries.pop(0)
+            else:
+                nxt = list(itertools.islice(items, 1))
+                if len(nxt) == 0:
+                    break
+                index, values = nxt[0]
+                entry = (index, values, 0, time.time())
+            entry = entry[:2] + (entry[2] + 1,) + entry[3:]
+            job, error = _submit(entry)
+            if job is None:
+                finished.append((entry, None, None, error))
+            else:
+                running.append((entry, job))
+        if not running and not finished and not retries:
+            return
+        if running:
+            statuses = [status for _, status in
+                        imap(lambda item: _job_status(item[1]), running,
+                             max_workers=max_concurrent)]
+            still_running = []
+            for (entry, job), status in zip(running, statuses):
+                if isinstance(status, Exception):
+                    # a failed status check does not mean the job failed
+                    still_running.append((entry, job))
+                elif status in FINISHED_STATUSES:
+                    error = None
+                    if status != "esriJobSucceeded":
+                        error = Exception("Job %s: %s" % (job.jobId, status))
+                    finished.append((entry, job, status, error))
+                else:
+                    still_running.append((entry, job))
+            running = still_running
+        for entry, job, status, error in finished:
+            if error is not None and entry[2] <= max_retries:
+                retries.append(entry)
+            else:
+                yield _report(entry, job, status, error)
+        if finished:
+            wait = poll_interval
+        elif running:
+            time.sleep(wait)
+            wait = min(wait * 2, max_poll_interval)
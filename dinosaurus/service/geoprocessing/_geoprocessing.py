@@ -8,12 +8,81 @@
 
 """
 from __future__ import absolute_import
+import os
 import json
-from ._gpobjects import GPBoolean, GPDataFile, GPDate
-from ._gpobjects import GPDouble, GPFeatureRecordSetLayer, GPLinearUnit
-from ._gpobjects import GPLong, GPMultiValue, GPRasterData
-from ._gpobjects import GPRasterDataLayer, GPRecordSet, GPString
+import tempfile
+import six
+from collections import Mapping
+from ._gpobjects import GPFeatureRecordSetLayer, GPRecordSet
+from ._gpobjects import from_param
+from .._uploads import Uploads
 from ...common._base import BaseService
+from ...common._parallel import imap
+
+_JOB_DONE = ("esriJobSucceeded", "esriJobFailed", "esriJobTimedOut",
+             "esriJobCancelled", "esriJobDeleted")
+#----------------------------------------------------------------------
+def _delete_uploads(con, url, itemIDs):
+    """
+    deletes uploaded items from an uploads resource. An item that cannot
+    be deleted is left to the server's upload deletion rules.
+    """
+    uploads = Uploads(connection=con, url=url)
+    for itemID in itemIDs:
+        try:
+            uploads.delete(itemID)
+        except Exception:
+            pass
+#----------------------------------------------------------------------
+def _estimate_size(value, sample=50):
+    """
+    estimates the number of bytes of the JSON encoding of a record set
+    from a sample of its features
+    """
+    features = value.get('features', None)
+    if not features:
+        return len(json.dumps(value))
+    head = dict((k, v) for k, v in value.items() if k != 'features')
+    step = max(1, len(features) // sample)
+    sampled = features[::step][:sample]
+    per_feature = len(json.dumps(sampled)) / float(len(sampled))
+    return len(json.dumps(head)) + per_feature * len(features)
+########################################################################
+class GPJobResults(Mapping):
+    """
+    The results of a GPJob, keyed by the result name. A result is only
+    downloaded when it is read, ex: job.results['out'] requests 'out'
+    alone. Use load() to download several of them concurrently.
+    """
+    _job = None
+    _names = None
+    #----------------------------------------------------------------------
+    def __init__(self, job, names):
+        """Constructor"""
+        self._job = job
+        self._names = list(names)
+    #----------------------------------------------------------------------
+    def __getitem__(self, name):
+        if not name in self._names:
+            raise KeyError(name)
+        return self._job.getParameterValue(name)
+    #----------------------------------------------------------------------
+    def __iter__(self):
+        return iter(self._names)
+    #----------------------------------------------------------------------
+    def __len__(self):
+        return len(self._names)
+    #----------------------------------------------------------------------
+    def __repr__(self):
+        return "<GPJobResults %s>" % self._names
+    #----------------------------------------------------------------------
+    def load(self, names=None, max_workers=4):
+        """
+        downloads the named results (all when names is None) concurrently
+        and returns them as a dictionary
+        """
+        return self._job._result_params(names=names or self._names,
+                                        max_workers=max_workers)
 ########################################################################
 class GPService(BaseService):
     """
@@ -63,6 +132,7 @@ class GPService(BaseService):
     _currentVersion = None
     _maximumRecords = None
     _serviceDescription = None
+    _task_list = None
     #----------------------------------------------------------------------
     @property
     def currentVersion(self):
@@ -77,28 +147,34 @@ class GPService(BaseService):
             self.init()
         return self._resultMapServerName
     #----------------------------------------------------------------------
-    def _load_tasks(self):
-        """ loads the GPTask into GPTask Objects """
-        self._tasks = []
+    def _load_tasks(self, max_workers=4):
+        """ loads the GPTask into GPTask Objects, concurrently """
         if self._json_dict is None:
             self.init(connection=self._con)
-        json_dict = dict(self)
-        if isinstance(json_dict, dict) and \
-           json_dict.has_key("tasks"):
-            for l in json_dict['tasks']:
-                self._tasks.append(GPTask(
+        tasks = []
+        if isinstance(self._json_dict, dict) and \
+           "tasks" in self._json_dict:
+            for l in self._json_dict['tasks']:
+                tasks.append(GPTask(
                         connection=self._con,
                         url=self._url + "/%s" % l,
-                        initialize=True))
-                del l
+                        initialize=False))
+        for _ in imap(lambda task: task.init(), tasks,
+                      max_workers=max_workers):
+            pass
+        self._task_list = tasks
     #----------------------------------------------------------------------
     @property
     def tasks(self):
-        """ returns the tasks in the GP service """
-        if self._tasks is None:
-            self.init()
-        self._load_tasks()
-        return self._tasks
+        """ returns the tasks in the GP service, loaded once """
+        if self._task_list is None:
+            self._load_tasks()
+        return self._task_list
+    #----------------------------------------------------------------------
+    def refresh(self):
+        """reloads the service and its tasks"""
+        self._task_list = None
+        self.init()
     #----------------------------------------------------------------------
     @property
     def executionType(self):
@@ -134,6 +210,8 @@ class GPTask(BaseService):
     _executionType = None
     _helpUrl = None
     _description = None
+    _parsed_parameters = None
+    _upload_threshold = 10 * 1024 * 1024
     #----------------------------------------------------------------------
     @property
     def executionType(self):
@@ -179,46 +257,102 @@ class GPTask(BaseService):
     #----------------------------------------------------------------------
     @property
     def parameters(self):
-        """ returns the default parameters """
-        if self._json_dict is None:
-            self.init(self._con)
-        if "parameters" in self._json_dict:
-            for param in self.parameters:
-                if isinstance(param['defaultValue'], (dict,str, list)):
-                    if param['dataType'] == "GPFeatureRecordSetLayer":
-                        param['defaultValue'] = GPFeatureRecordSetLayer.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPString":
-                        param['defaultValue'] = GPString.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPLong":
-                        param['defaultValue'] = GPLong.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPDouble":
-                        param['defaultValue'] = GPDouble.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPDate":
-                        param['defaultValue'] = GPDate.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPBoolean":
-                        param['defaultValue'] = GPBoolean.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPDataFile":
-                        param['defaultValue'] = GPDataFile.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPLinearUnit":
-                        param['defaultValue'] = GPLinearUnit.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPMultiValue":
-                        param['defaultValue'] = GPMultiValue.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPRasterData":
-                        param['defaultValue'] = GPRasterData.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPRasterDataLayer":
-                        param['defaultValue'] = GPRasterDataLayer.fromJSON(json.dumps(param))
-                    elif param['dataType'] == "GPRecordSet":
-                        param['defaultValue'] = GPRecordSet.fromJSON(json.dumps(param))
-        return self._parameters
+        """
+        returns the parameters of the task, with each default value as a
+        GP object. The parameters are parsed once and kept.
+        """
+        if self._parsed_parameters is None:
+            if self._json_dict is None:
+                self.init(self._con)
+            parameters = []
+            for param in self._json_dict.get("parameters", None) or []:
+                param = dict(param)
+                if isinstance(param.get('defaultValue', None),
+                              (dict, list) + six.string_types):
+                    value = from_param(param)
+                    if not value is param:
+                        param['defaultValue'] = value
+                parameters.append(param)
+            self._parsed_parameters = parameters
+        return self._parsed_parameters
+    #----------------------------------------------------------------------
+    def refresh(self):
+        """reloads the task and its parameters"""
+        self._parsed_parameters = None
+        self.init()
     #----------------------------------------------------------------------
     def getJob(self, jobID):
         """ returns the results or status of a job """
         url = self._url + "/jobs/%s" % (jobID)
         return GPJob(connection=self._con, url=url)
     #----------------------------------------------------------------------
+    def _upload_value(self, value):
+        """
+        streams a record set to a .json file, uploads it to the service's
+        uploads resource and returns the itemID of the upload
+        """
+        fd, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in json.JSONEncoder().iterencode(value):
+                    f.write(chunk.encode('utf-8'))
+            uploads = Uploads(connection=self._con, url=self._uploads_url)
+            res = uploads.upload(filePath=path)
+        finally:
+            if os.path.isfile(path):
+                os.remove(path)
+        if isinstance(res, dict) and 'item' in res:
+            return res['item']['itemID']
+        raise Exception("The input could not be uploaded: %s" % res)
+    #----------------------------------------------------------------------
+    @property
+    def _uploads_url(self):
+        """returns the url of the service's uploads resource"""
+        return self._url.rsplit('/', 1)[0] + "/uploads"
+    #----------------------------------------------------------------------
+    def _input_params(self, inputs, upload_threshold=None, uploaded=None):
+        """
+        returns the request parameters of a list of GP objects. Record
+        sets estimated to be larger than upload_threshold bytes are
+        uploaded and passed by itemID instead of inline, and the itemIDs
+        are appended to the uploaded list.
+        """
+        if upload_threshold is None:
+            upload_threshold = self.upload_threshold
+        params = {}
+        for p in inputs or []:
+            if isinstance(p, dict):
+                name, value = p['paramName'], p['value']
+            else:
+                name, value = p.paramName, p.value
+            if upload_threshold and \
+               isinstance(p, (GPFeatureRecordSetLayer, GPRecordSet)) and \
+               isinstance(value, dict) and \
+               _estimate_size(value) > upload_threshold:
+                value = {"itemID" : self._upload_value(value)}
+                if uploaded is not None:
+                    uploaded.append(value['itemID'])
+            params[name] = value
+        return params
+    #----------------------------------------------------------------------
+    @property
+    def upload_threshold(self):
+        """
+        gets/sets the estimated size in bytes above which record set
+        inputs are uploaded instead of sent in the request. None or 0
+        always sends them inline.
+        """
+        return self._upload_threshold
+    #----------------------------------------------------------------------
+    @upload_threshold.setter
+    def upload_threshold(self, value):
+        """gets/sets the upload threshold"""
+        self._upload_threshold = value
+    #----------------------------------------------------------------------
     def submit_job(self, inputs, method="POST",
                   outSR=None, processSR=None,
-                  returnZ=False, returnM=False):
+                  returnZ=False, returnM=False,
+                  upload_threshold=None):
         """
            submits a job to the current task, and returns a job ID
            Inputs:
@@ -230,9 +364,17 @@ class GPTask(BaseService):
                perform geometry operations
               returnZ - Z values will be included in the result if true
               returnM - M values will be included in the results if true
+              upload_threshold - optional size in bytes above which record
+               set inputs are uploaded and passed by itemID. The default
+               is the task's upload_threshold. The uploaded items are
+               deleted once the job is seen to have finished, whether it
+               succeeded or not.
            Ouput:
-              JOB ID as a string
+              GPJob
         """
+        if not method.lower() in ("get", "post"):
+            raise AttributeError("Invalid input: %s. Must be GET or POST" \
+                                 % method)
         url = self._url + "/submitJob"
         params = { "f" : "json" }
         if not outSR is None:
@@ -241,26 +383,25 @@ class GPTask(BaseService):
             params['end:processSR'] = processSR
         params['returnZ'] = returnZ
         params['returnM'] = returnM
-        if not inputs is None:
-            for p in inputs:
-                if isinstance(p, dict):
-                    params[p.paramName] = p
-                else:
-                    params[p.paramName] = p.value
-        if method.lower() == "get":
-            res = self._con.get(path=url, params=params)
-            jobUrl = self._url + "/jobs/%s" % res['jobId']
-            return GPJob(connection=self._con, url=jobUrl,
-                          initialize=True)
-        elif method.lower() == "post":
-            res = self._con.post(path=url, params=params)
+        uploaded = []
+        try:
+            params.update(self._input_params(inputs, upload_threshold,
+                                             uploaded))
+            if method.lower() == "get":
+                res = self._con.get(path=url, params=params)
+            else:
+                res = self._con.post(path=url, params=params)
             jobUrl = self._url + "/jobs/%s" % res['jobId']
-            return GPJob(url=jobUrl,
-                         connection=self._con,
-                         initialize=True)
-        else:
-            raise AttributeError("Invalid input: %s. Must be GET or POST" \
-                                 % method)
+        except:
+            _delete_uploads(self._con, self._uploads_url, uploaded)
+            raise
+        job = GPJob(url=jobUrl,
+                    connection=self._con,
+                    initialize=False)
+        job._uploads = uploaded
+        job._uploads_url = self._uploads_url
+        job.init()
+        return job
     #----------------------------------------------------------------------
     def execute_task(self,
                     inputs,
@@ -269,10 +410,13 @@ class GPTask(BaseService):
                     returnZ=False,
                     returnM=False,
                     f="json",
-                    method="POST"
+                    method="POST",
+                    upload_threshold=None
                     ):
         """
-        performs the execute task method
+        performs the execute task method. Record set inputs larger than
+        upload_threshold bytes (default the task's upload_threshold) are
+        uploaded and passed by itemID, and deleted once the task returns.
         """
         params = {
             "f" : f
@@ -285,16 +429,16 @@ class GPTask(BaseService):
             params['end:processSR'] = processSR
         params['returnZ'] = returnZ
         params['returnM'] = returnM
-        for p in inputs:
-            if isinstance(p, dict):
-                params[p.paramName] = p
+        uploaded = []
+        try:
+            params.update(self._input_params(inputs, upload_threshold,
+                                             uploaded))
+            if method.lower() == "post":
+                return self._con.post(path=url, postdata=params)
             else:
-                params[p.paramName] = p.value
-            del p
-        if method.lower() == "post":
-            return self._con.post(path=url, postdata=params)
-        else:
-            return self._con.get(path=url, params=params)
+                return self._con.get(path=url, params=params)
+        finally:
+            _delete_uploads(self._con, self._uploads_url, uploaded)
 ########################################################################
 class GPJob(BaseService):
     """
@@ -308,6 +452,19 @@ class GPJob(BaseService):
     _messages = None
     _jobStatus = None
     _inputs = None
+    _result_values = None
+    _uploads = None
+    _uploads_url = None
+    #----------------------------------------------------------------------
+    def init(self, connection=None):
+        """
+        loads the job, and deletes the inputs uploaded for it once the job
+        has finished
+        """
+        super(GPJob, self).init(connection=connection)
+        if self._uploads and self._jobStatus in _JOB_DONE:
+            uploads, self._uploads = self._uploads, None
+            _delete_uploads(self._con, self._uploads_url, uploads)
     #----------------------------------------------------------------------
     def cancelJob(self):
         """ cancels the job """
@@ -335,42 +492,51 @@ class GPJob(BaseService):
         return self._con.get(path=url,
                             params=params)
     #----------------------------------------------------------------------
+    def _fetch_result(self, info):
+        """fetches a single result parameter and builds its GP object"""
+        if not isinstance(info, dict) or not 'paramUrl' in info:
+            return info
+        param = self._get_json(info['paramUrl'])
+        if isinstance(param, dict) and 'dataType' in param:
+            return from_param(param)
+        return param
+    #----------------------------------------------------------------------
+    def _result_params(self, names=None, max_workers=4):
+        """
+        returns the GP objects of the named results (all when names is
+        None). Results are requested concurrently and, once the job has
+        succeeded, kept so they are only downloaded once.
+        """
+        if self._jobStatus != "esriJobSucceeded":
+            self.init()
+        if self._result_values is None:
+            self._result_values = {}
+        if not isinstance(self._results, dict):
+            return self._results
+        if names is None:
+            names = list(self._results.keys())
+        missing = [n for n in names if not n in self._result_values]
+        fetched = {}
+        for index, value in imap(lambda n: self._fetch_result(self._results[n]),
+                                 missing, max_workers=max_workers):
+            fetched[missing[index]] = value
+        if self._jobStatus == "esriJobSucceeded":
+            self._result_values.update(fetched)
+            return dict((n, self._result_values[n]) for n in names)
+        return fetched
+    #----------------------------------------------------------------------
     @property
     def results(self):
-        """ returns the results """
-        self.init()
-        if isinstance(self._results, dict):
-            for k,v in self._results.items():
-                param = self._get_json(v['paramUrl'])
-                if param['dataType'] == "GPFeatureRecordSetLayer":
-                    self._results[k] = GPFeatureRecordSetLayer.fromJSON(json.dumps(param))
-                elif param['dataType'].lower().find('gpmultivalue') > -1:
-                    self._results[k] = GPMultiValue.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPString":
-                    self._results[k] = GPString.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPLong":
-                    self._results[k] = GPLong.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPDouble":
-                    self._results[k] = GPDouble.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPDate":
-                    self._results[k] = GPDate.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPBoolean":
-                    self._results[k] = GPBoolean.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPDataFile":
-                    self._results[k] = GPDataFile.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPLinearUnit":
-                    self._results[k] = GPLinearUnit.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPMultiValue":
-                    self._results[k] = GPMultiValue.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPRasterData":
-                    self._results[k] = GPRasterData.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPRasterDataLayer":
-                    self._results[k] = GPRasterDataLayer.fromJSON(json.dumps(param))
-                elif param['dataType'] == "GPRecordSet":
-                    self._results[k] = GPRecordSet.fromJSON(json.dumps(param))
-            return self._results
-        else:
+        """
+        returns a GPJobResults mapping of the result name to its GP
+        object. A result is downloaded the first time it is read and,
+        once the job has succeeded, kept afterwards.
+        """
+        if self._jobStatus != "esriJobSucceeded":
+            self.init()
+        if not isinstance(self._results, dict):
             return self._results
+        return GPJobResults(self, self._results.keys())
     #----------------------------------------------------------------------
     @property
     def jobStatus(self):
@@ -392,8 +558,5 @@ class GPJob(BaseService):
         return self._inputs
     #----------------------------------------------------------------------
     def getParameterValue(self, parameterName):
-        """ gets a parameter value """
-        if  self._results is None:
-            self.init()
-        parameter = self._results[parameterName]
-        return parameter
\ No newline at end of file
+        """ gets a parameter value, downloading only that result """
+        return self._result_params(names=[parameterName])[parameterName]
\ No newline at end of file
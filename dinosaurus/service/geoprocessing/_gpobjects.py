@@ -10,6 +10,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import json
+from ...common._featureset import FeatureSet
 ########################################################################
 class GPMultiValue(object):
     """
@@ -97,6 +98,7 @@ class GPRecordSet(object):
     _value = None
     _paramName = None
     _type = None
+    _featureset = None
     #----------------------------------------------------------------------
     def __init__(self):
         """Constructor"""
@@ -124,6 +126,15 @@ class GPRecordSet(object):
         """gets/sets the object as a dictionary"""
         if isinstance(value, dict):
             self._value = value
+            self._featureset = None
+    #----------------------------------------------------------------------
+    @property
+    def featureset(self):
+        """returns the value as a FeatureSet"""
+        if self._featureset is None and \
+           isinstance(self._value, dict):
+            self._featureset = FeatureSet.from_dict(self._value)
+        return self._featureset
     #----------------------------------------------------------------------
     @property
     def dataType(self):
@@ -183,6 +194,7 @@ class GPFeatureRecordSetLayer(object):
     """
     _value = None
     _paramName = None
+    _featureset = None
     #----------------------------------------------------------------------
     def __init__(self):
         """Constructor"""
@@ -210,6 +222,15 @@ class GPFeatureRecordSetLayer(object):
         """gets/sets the object as a dictionary"""
         if isinstance(value, dict):
             self._value = value
+            self._featureset = None
+    #----------------------------------------------------------------------
+    @property
+    def featureset(self):
+        """returns the value as a FeatureSet"""
+        if self._featureset is None and \
+           isinstance(self._value, dict):
+            self._featureset = FeatureSet.from_dict(self._value)
+        return self._featureset
     #----------------------------------------------------------------------
     @property
     def dataType(self):
@@ -847,3 +868,41 @@ class GPDouble(object):
         elif 'name' in j:
             v.paramName = j['name']
         return v
+#----------------------------------------------------------------------
+_GP_TYPES = {
+    "GPRecordSet" : GPRecordSet,
+    "GPFeatureRecordSetLayer" : GPFeatureRecordSetLayer,
+    "GPRasterDataLayer" : GPRasterDataLayer,
+    "GPRasterData" : GPRasterData,
+    "GPDataFile" : GPDataFile,
+    "GPLinearUnit" : GPLinearUnit,
+    "GPDate" : GPDate,
+    "GPBoolean" : GPBoolean,
+    "GPLong" : GPLong,
+    "GPString" : GPString,
+    "GPDouble" : GPDouble
+}
+#----------------------------------------------------------------------
+def from_param(param):
+    """
+    builds the GP object of a parameter dictionary returned by a task or a
+    job. Unlike fromJSON, the dictionary is used as is, so large record
+    sets are not encoded and parsed again. Unknown data types are
+    returned unchanged.
+    """
+    data_type = param.get('dataType', "")
+    if data_type.startswith("GPMultiValue"):
+        v = GPMultiValue(gptype=data_type.split(":", 1)[-1])
+    elif data_type in _GP_TYPES:
+        v = _GP_TYPES[data_type]()
+    else:
+        return param
+    if "defaultValue" in param:
+        v.value = param['defaultValue']
+    else:
+        v.value = param.get('value', None)
+    if 'paramName' in param:
+        v.paramName = param['paramName']
+    elif 'name' in param:
+        v.paramName = param['name']
+    return v